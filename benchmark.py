@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Measures scraper.py end to end against recorded fixtures instead of the real APIs.
+
+    python benchmark.py record .cache/fixtures/default
+    python benchmark.py run .cache/fixtures/default --runs 3 --latency 50 [--async] [--json results.json]
+    python benchmark.py index --sizes 1000,10000,20000
+    python benchmark.py startup --runs 5 --budget 300
+
+Every run is a fresh process in an empty working directory, so runs do not
+share caches, images or memory and their numbers are comparable. `index`
+times the lookups of the movie and show scrapers on synthetic data instead,
+their time per entry should stay flat as the sizes grow. `startup` measures
+`import scraper` with -X importtime and fails when it goes over the budget,
+or when it loads a dependency that only some runs need.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# only loaded by the runs that use them: the bucket client, image workers, Letterboxd and the asyncio runtime
+LAZY_MODULES = ('supabase', 'storage3', 'PIL', 'feedparser', 'httpx', 'asyncio', 'unidecode')
+STARTUP_BUDGET = 300  # milliseconds `import scraper` may take
+
+
+def record(args):
+    fixtures = os.path.abspath(args.fixtures)
+    with tempfile.TemporaryDirectory() as workdir:
+        run_child(workdir, ['--record', fixtures])
+
+
+def benchmark(args):
+    fixtures = os.path.abspath(args.fixtures)
+    scraper_args = ['--replay', fixtures, '--latency', args.latency] + (['--async'] if args.async_mode else [])
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.warm:
+            print('Warming caches...')
+            run_child(workdir, scraper_args)
+        for i in range(args.runs):
+            run_dir = workdir if args.warm else tempfile.mkdtemp(dir=workdir)
+            result = run_child(run_dir, scraper_args)
+            print(f'Run {i + 1}/{args.runs}: {result["wall"]:.2f}s, peak RSS {result["rss"] / 1024:.1f} MiB '
+                  f'(largest worker {result["children_rss"] / 1024:.1f} MiB)')
+            results.append(result)
+
+    print_summary(args, results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump({'args': vars(args), 'runs': results}, f, indent=1)
+
+
+def run_child(workdir, scraper_args):
+    result_path = os.path.join(workdir, 'benchmark-result.json')
+    log_path = os.path.join(workdir, 'scraper.log')
+    with open(log_path, 'w', encoding='utf8') as log:
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'child', result_path, '--', *scraper_args],
+                       cwd=workdir, stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(result_path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def child(args):
+    """Runs the scraper in the current directory and writes what it measured to `result`"""
+    sys.path.insert(0, REPO_DIR)
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(REPO_DIR, '.env'))
+    import scraper
+    from scraping.net import get_client
+    from scraping.trace import get_tracer
+
+    os.makedirs('data', exist_ok=True)
+    os.makedirs('static', exist_ok=True)
+    start = time.perf_counter()
+    scraper.main(scraper.parse_args(args.scraper_args))
+    wall = time.perf_counter() - start
+
+    replay = get_client().replay
+    result = {
+        'wall': wall,
+        'sources': get_tracer().durations('section'),
+        'requests': replay.requests if replay is not None else {},
+        'bucket': replay.bucket.calls if replay is not None else {},
+        'missing': len(replay.missing) if replay is not None else 0,
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # KiB on Linux
+        'children_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    with open(args.result, 'w', encoding='utf8') as f:
+        json.dump(result, f)
+
+
+class FakePlex:
+    def __init__(self, rows, metadata):
+        self._rows = rows
+        self._metadata = metadata
+
+    def rows(self, media_type):
+        return self._rows
+
+    def metadata(self, rating_keys):
+        return self._metadata
+
+    def image_url(self, thumb, width):
+        return thumb
+
+
+class NoImages:
+    def submit(self, *args, **kwargs):
+        pass
+
+
+def index(args):
+    sys.path.insert(0, REPO_DIR)
+    import scraper
+    from scraping.index import ItemIndex
+    from scraping.items import CINEMA_LISTS, cinema_movies, group_episodes
+
+    print(f'{"entries":>8} {"cinema_movies":>14} {"group_episodes":>15} {"scrape_movies":>14}')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        films = [{'title': f'Film {i}, {2000 + i % 20}', 'letterboxd_filmtitle': f'Film {i}'} for i in range(size)]
+        summary = ''.join(f'<li><a href="https://letterboxd.com/film/film-{i}/">Film {i}</a></li>' for i in range(size))
+        feed = {'entries': films + [{'title': CINEMA_LISTS[0], 'summary': summary}]}
+        shows = size // 10 + 1
+        episodes = [{'grandparent_rating_key': i % shows, 'grandparent_title': f'Show {i % shows}',
+                     'grandchild_title': f'Episode {i}', 'parent_media_index': 1, 'media_index': i, 'last_watch': i}
+                    for i in range(size)]
+        rows = [{'rating_key': i, 'title': f'Movie {i}', 'year': 2000, 'thumb': f'/thumb/{i}', 'last_watch': i}
+                for i in range(size)]
+        metadata = {str(i): {'guids': [{}, f'tmdb://{i // 2}']} for i in range(size)}  # every guid twice
+
+        timings = [
+            timed(cinema_movies, feed),
+            timed(group_episodes, episodes),
+            timed(scraper.scrape_movies, ItemIndex([], 'guid'), FakePlex(rows, metadata), size, 0, NoImages()),
+        ]
+        print(f'{size:>8} ' + ' '.join(f'{t * 1000:11.1f}ms' for t in timings) +
+              f'   ({", ".join(f"{t / size * 1e6:.2f}" for t in timings)} µs per entry)')
+
+
+def startup(args):
+    total, imports, loaded = measure_startup(args.runs)
+    print(f'import scraper: median {total:.0f}ms over {args.runs} runs, budget {args.budget}ms')
+    print('Slowest imports of the last run: ' + ', '.join(
+        f'{name} {ms:.0f}ms' for name, ms in sorted(imports.items(), key=lambda item: -item[1])[:8]))
+    if loaded:
+        print(f'Warning: imported at startup instead of when first used: {", ".join(loaded)}')
+    if loaded or total > args.budget:
+        sys.exit(1)
+
+
+def measure_startup(runs):
+    """Times `import scraper` in `runs` fresh processes with -X importtime.
+
+    Returns (median milliseconds, {module scraper.py imports: cumulative milliseconds} of the last run,
+    LAZY_MODULES that were imported).
+    """
+    code = 'import sys, scraper; print(",".join(sorted(sys.modules)), file=sys.stderr)'
+    totals = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True)
+        *lines, modules = result.stderr.splitlines()
+        imports = {}
+        for line in lines:
+            _, cumulative, name = line.split('|')
+            if name.startswith('   ') and not name.startswith('    '):  # indented once, printed before its parent
+                imports[name.strip()] = int(cumulative) / 1000
+            elif name.strip() == 'scraper':
+                totals.append(int(cumulative) / 1000)
+                break
+            elif not name.startswith('  '):  # some other top level import, e.g. site
+                imports = {}
+        modules = set(modules.split(','))
+    return statistics.median(totals), imports, [module for module in LAZY_MODULES if module in modules]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def print_summary(args, results):
+    mode = 'async' if args.async_mode else 'threaded'
+    print(f'\nMedian of {len(results)} runs ({mode}, latency {args.latency}ms, {"warm" if args.warm else "cold"}):')
+    print(f'  {"wall time":<12} {statistics.median(r["wall"] for r in results):8.2f}s')
+    for source in sorted({s for r in results for s in r['sources']}):
+        print(f'  {source:<12} {statistics.median(r["sources"].get(source, 0.0) for r in results):8.2f}s')
+    print(f'  {"peak RSS":<12} {statistics.median(r["rss"] for r in results) / 1024:8.1f} MiB')
+
+    last = results[-1]
+    print(f'Requests: {sum(last["requests"].values())} HTTP, ' + ', '.join(
+        f'{host} {count}' for host, count in sorted(last['requests'].items(), key=lambda item: -item[1])))
+    print('Bucket calls: ' + (', '.join(f'{count} {op}' for op, count in sorted(last['bucket'].items())) or 'none'))
+    if last['missing']:
+        print(f'Warning: {last["missing"]} requests had no fixture, re-record the fixtures')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks scraper.py against recorded fixtures')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='run the scraper once against the real APIs and save fixtures')
+    record_parser.add_argument('fixtures', help='fixture directory, keep it out of git since URLs include API keys')
+
+    run_parser = commands.add_parser('run', help='replay the fixtures and report timings')
+    run_parser.add_argument('fixtures')
+    run_parser.add_argument('--runs', type=int, default=3)
+    run_parser.add_argument('--latency', default='0', help="milliseconds added to every response, or 'recorded'")
+    run_parser.add_argument('--async', dest='async_mode', action='store_true', help='benchmark scraper.py --async')
+    run_parser.add_argument('--warm', action='store_true', help='reuse caches and images from an unmeasured first run')
+    run_parser.add_argument('--json', help='also write every run to this file, to compare changes')
+
+    index_parser = commands.add_parser('index', help='time the dedup and lookup helpers on synthetic data')
+    index_parser.add_argument('--sizes', default='1000,10000,20000', help='comma separated entry counts')
+
+    startup_parser = commands.add_parser('startup', help='time `import scraper` against an import time budget')
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--budget', type=int, default=STARTUP_BUDGET, help='milliseconds the median may take')
+
+    child_parser = commands.add_parser('child')
+    child_parser.add_argument('result')
+    child_parser.add_argument('scraper_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.command == 'child' and args.scraper_args[:1] == ['--']:
+        args.scraper_args = args.scraper_args[1:]
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    {'record': record, 'run': benchmark, 'index': index, 'startup': startup, 'child': child}[args.command](args)
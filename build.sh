@@ -1,21 +1,34 @@
 # /bin/bash
 
-# Install cwebp
-wget -c https://storage.googleapis.com/downloads.webmproject.org/releases/webp/libwebp-1.6.0-linux-x86-64.tar.gz
-tar -xvf libwebp-1.6.0-linux-x86-64.tar.gz
-export PATH=$PATH:"$(pwd)"/libwebp-1.6.0-linux-x86-64/bin
+# Hash of every file Hugo builds the site from, recorded after each successful build
+SITE_STAMP=.cache/site.sha256
+site_stamp() {
+    find content layouts assets static data config.toml -type f ! -name '*.part' -print0 \
+        | sort -z | xargs -0 sha256sum | sha256sum | cut -d ' ' -f 1
+}
 
-# Scrape content
-python scraper.py
+# Scrape content, exits with 3 when the data is the same as in the last run
+python scraper.py --only-due
+status=$?
 
 # Check if scraping was successful
-if [ $? -ne 0 ]; then
+if [ $status -ne 0 ] && [ $status -ne 3 ]; then
     echo "Scraping failed"
     exit 1
 fi
 
+# Nothing to rebuild if neither the data nor the content and layouts changed since the site was built
+if [ $status -eq 3 ] && [ -d public ] && [ "$(site_stamp)" = "$(cat $SITE_STAMP 2>/dev/null)" ]; then
+    echo "Scraped data and site sources unchanged, skipping Hugo build"
+    exit 0
+fi
+
+# Encode the page bundle images, only new or changed ones are encoded again
+python optimize_assets.py
+
 # Build site
-hugo -b https://edoardo.fyi/ --minify --gc
+hugo -b https://edoardo.fyi/ --minify --gc || exit 1
+mkdir -p .cache && site_stamp > $SITE_STAMP
 
 # Run torchlight
 npx torchlight
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Encodes the images of the page bundles under content/ to the WebP (and AVIF) widths the img shortcode offers.
+
+    python optimize_assets.py [--content content] [--force]
+
+Variants are written to static/assets/<bundle>/ and listed in data/assets.json,
+which the img shortcode reads instead of resizing the images on every build.
+.cache/assets.json remembers the sha256 every image was encoded from, so only
+new or changed images are encoded again.
+"""
+import argparse
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+from PIL import Image
+
+from scraping.images import (AVIF_QUALITY, WEBP_QUALITY, ImageVariant, avif_supported, encode_variants, get_pool,
+                             saving, shutdown_pool, write_outputs)
+
+CONTENT_DIR = 'content'
+ASSET_DIR = 'static/assets'
+ASSET_URL = '/assets'
+MANIFEST_PATH = 'data/assets.json'  # site.Data.assets for Hugo
+CACHE_PATH = '.cache/assets.json'
+DISPLAY_WIDTH = 900  # widest the img shortcode renders an image
+ASSET_WIDTHS = (450, 900, 1800)  # half, full and 2x of DISPLAY_WIDTH
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+CHUNK_SIZE = 64 * 1024
+
+
+def main(args):
+    cache = load_json(CACHE_PATH)
+    settings = encoder_settings()
+    images = find_images(args.content)
+    jobs = {}
+    for key in images:
+        path = os.path.join(args.content, key)
+        digest = file_hash(path)
+        cached = cache.get(key)
+        if not args.force and cached is not None and cached['sha256'] == digest and cached['settings'] == settings \
+                and all(os.path.exists(os.path.join(args.output, file)) for file in cached['files']):
+            continue
+        try:
+            with Image.open(path) as image:
+                size, source_format = image.size, image.format
+        except OSError as exc:
+            print(f'Warning: Skipping {key}: {exc}')
+            continue
+        variants = asset_variants(key, size[0], source_format)
+        folder = os.path.join(args.output, os.path.dirname(key))
+        os.makedirs(folder, exist_ok=True)
+        jobs[key] = (path, digest, size, variants, folder, get_pool().submit(encode_variants, path, variants))
+
+    for key, (path, digest, size, variants, folder, future) in jobs.items():
+        try:
+            outputs, _, elapsed = future.result()
+            write_outputs(path, variants, outputs, elapsed, folder)
+        except Exception as exc:
+            print(f'Warning: Failed to encode {key}: {exc}')
+            continue
+        entry = cache_entry(key, digest, settings, size, variants, os.path.getsize(path), folder)
+        remove_files(args.output, set(cache.get(key, {}).get('files', ())) - set(entry['files']))
+        cache[key] = entry
+    shutdown_pool()
+
+    for key in [key for key in cache if key not in images]:
+        remove_files(args.output, cache.pop(key)['files'])
+
+    manifest = {key: cache[key]['manifest'] for key in images if key in cache}
+    write_json(MANIFEST_PATH, manifest)
+    write_json(CACHE_PATH, cache)
+    print_report(cache, images, jobs)
+
+
+def find_images(content_dir):
+    """Paths of the images under `content_dir`, relative to it and with forward slashes like Hugo's File.Dir"""
+    images = []
+    for root, dirs, files in os.walk(content_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(os.path.relpath(os.path.join(root, file), content_dir).replace(os.sep, '/'))
+    return images
+
+
+def asset_variants(key, width, source_format):
+    """WebP (and AVIF) at every ASSET_WIDTHS up to `width`, plus the original format at the smaller widths.
+
+    Filenames are relative to the asset folder of the image's bundle.
+    """
+    stem = os.path.splitext(os.path.basename(key))[0]
+    variants = []
+    for target in sorted({min(target, width) for target in ASSET_WIDTHS}):
+        variants.append(ImageVariant(f'{stem}-{target}w.webp', 'webp', target))
+        if avif_supported():
+            variants.append(ImageVariant(f'{stem}-{target}w.avif', 'avif', target))
+        if target < width:
+            ext = 'jpg' if source_format == 'JPEG' else 'png'
+            variants.append(ImageVariant(f'{stem}-{target}w.{ext}', 'orig', target))
+    return variants
+
+
+def cache_entry(key, digest, settings, size, variants, source_size, folder):
+    """What the next run needs to skip the image, and its entry in the manifest of the img shortcode.
+
+    `served_size` is the smallest file a browser gets at DISPLAY_WIDTH.
+    """
+    width, height = size
+    display = min(width, DISPLAY_WIDTH)
+    base = f'{ASSET_URL}/{os.path.dirname(key)}'.rstrip('/')
+    sources = defaultdict(list)
+    images = []
+    src = None
+    served_size = source_size
+    for variant in variants:
+        url = f'{base}/{variant.filename}'
+        if variant.format == 'orig':
+            images.append(f'{url} {variant.width}w')
+            if variant.width == display:
+                src = url
+        else:
+            sources[MIME_TYPES[variant.format]].append(f'{url} {variant.width}w')
+        if variant.width == display:
+            served_size = min(served_size, os.path.getsize(os.path.join(folder, variant.filename)))
+    prefix = os.path.dirname(key)
+    return {
+        'sha256': digest,
+        'settings': settings,
+        'files': [f'{prefix}/{variant.filename}'.lstrip('/') for variant in variants],
+        'source_size': source_size,
+        'served_size': served_size,
+        'manifest': {
+            'width': display,
+            'height': round(height * display / width),
+            'original_width': width,
+            'src': src,
+            # AVIF first, browsers take the first <source> they support
+            'sources': [{'type': mime, 'srcset': ', '.join(sources[mime])}
+                        for mime in ('image/avif', 'image/webp') if mime in sources],
+            'images': images,
+        },
+    }
+
+
+def encoder_settings():
+    """Changes whenever the variants of an unchanged image would, which invalidates the whole cache"""
+    avif = AVIF_QUALITY if avif_supported() else 0
+    return f'widths={",".join(map(str, ASSET_WIDTHS))} webp={WEBP_QUALITY} avif={avif}'
+
+
+def print_report(cache, images, jobs):
+    posts = defaultdict(lambda: [0, 0, 0])
+    for key in images:
+        if key in cache:
+            post = posts[os.path.dirname(key) or '.']
+            post[0] += 1
+            post[1] += cache[key]['source_size']
+            post[2] += cache[key]['served_size']
+    print(f'Optimized {len(jobs)} of {len(images)} images, the others were unchanged')
+    for post, (count, source_size, served_size) in sorted(posts.items(), key=lambda item: item[1][2] - item[1][1]):
+        print(f'  {post:<40} {count:3} images {source_size / 1024:9.1f} KiB -> {served_size / 1024:9.1f} KiB, '
+              f'{(source_size - served_size) / 1024:.1f} KiB saved ({saving(source_size, served_size)})')
+    source_size = sum(post[1] for post in posts.values())
+    served_size = sum(post[2] for post in posts.values())
+    print(f'Total: {(source_size - served_size) / 1024:.1f} KiB saved ({saving(source_size, served_size)})')
+
+
+def remove_files(folder, files):
+    for file in files:
+        try:
+            os.remove(os.path.join(folder, file))
+        except OSError:
+            pass
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_json(path):
+    try:
+        with open(path, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path, value):
+    """Atomically replaces `path`, unless it already holds `value`"""
+    content = json.dumps(value, indent=1, sort_keys=True).encode('utf8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    tmp_path = f'{path}.part'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        print(f'Warning: Failed to write {path}: {exc}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Encodes the page bundle images for the img shortcode')
+    parser.add_argument('--content', default=CONTENT_DIR, help='directory with the page bundles')
+    parser.add_argument('--output', default=ASSET_DIR, help='where the variants are written, served under /assets')
+    parser.add_argument('--force', action='store_true', help='encode every image again, ignoring the cache')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args())
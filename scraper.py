@@ -1,578 +1,391 @@
 # -*- coding: utf-8 -*-
+import argparse
 import concurrent
 import json
-from concurrent.futures import ThreadPoolExecutor
-
-import requests
 import os
-import re
 import subprocess
-import threading
+import sys
 import time
 import traceback
-from os.path import exists
-from urllib import parse
-import base64
+from concurrent.futures import ThreadPoolExecutor
+
 from dotenv import load_dotenv
-import feedparser
-from PIL import Image
-from datetime import UTC, datetime
-
-from storage3.utils import StorageException
-from supabase import create_client, Client, ClientOptions
-from unidecode import unidecode
-
-HTTP_TIMEOUT = 30
-STORAGE_TIMEOUT = 120
-UPLOAD_RETRIES = 3
-UPLOAD_CONCURRENCY = 3
-UPLOAD_SEMAPHORE = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
-BUCKET_FILES_LOCK = threading.Lock()
-
-
-def main():
-    data = {'movies': [], 'shows': [], 'books': [], 'spotify': [], 'github': [], 'videogames': []}
-    content_limit = 50
-    img_width = 350
+
+from scraping.cache import configure_cache, get_cache
+from scraping.deadline import budget
+from scraping.image_store import get_image_store
+from scraping.images import print_image_stats, shutdown_pool
+from scraping.index import ItemIndex
+from scraping.incremental import (compute_watermarks, load_previous_data, merge_by_key, merge_shows, plex_movies,
+                                  plex_shows)
+from scraping.items import (IMG_WIDTH, LETTERBOXD_RSS_URL, PLEX_CONTENT_LIMIT, TMDB_FAV_MOVIES, TMDB_FAV_SHOWS,
+                            TMDB_IMAGE_URL, TMDB_LIST_URL, cinema_image_url, cinema_movie_item, cinema_movies,
+                            group_episodes, plex_guid, plex_movie_item, plex_show_item, slugify, tmdb_movie_item,
+                            tmdb_show_item)
+from scraping.media import create_img_folder, read_local_file
+from scraping.net import configure_client, get_client
+from scraping.pipeline import PENDING_IMAGES, ImagePipeline
+from scraping.plex import PlexSource
+from scraping.records import encode_record
+from scraping.replay import Recorder, RecordingBucket, ReplayServer, parse_latency
+from scraping.schedule import due_sections, record_runs, seconds_until_due
+from scraping.shards import write_shards
+from scraping.sources import SOURCES, by_cost, select_sources
+from scraping.state import load_state, save_state
+from scraping.sync import BucketSync, get_supabase_bucket
+from scraping.trace import configure_tracer, span, traced
+from scraping.views import VIEWS_PATH, build_views
+
+OUTPUT_PATHS = ('data/scraper.json', 'static/data.json')  # read by Hugo and by the client side scripts
+EXIT_NO_CHANGES = 3  # the output is the same as before, build.sh can skip the Hugo build
+
+
+def main(args):
+    """Runs the scrapers once, returns 0 if the output changed and EXIT_NO_CHANGES otherwise"""
+    data = {name: [] for name in SOURCES}
+    selected = select_sources(args.sources)
+    scheduled = args.only_due or args.daemon
+    partial = scheduled or bool(args.sources)
+    state = load_state()
+    existing = load_previous_data() if args.incremental or partial else None
+    due = {source.name for source in selected}
+    if scheduled and existing is not None:
+        due = due_sections(state, {source.name: source.refresh for source in selected})
+    if partial:
+        names = [source.name for source in by_cost(selected) if source.name in due]
+        print(f'Sources to run: {", ".join(names) or "none"}')
+        if not due:
+            return EXIT_NO_CHANGES
+        for section in data:
+            if section not in due and existing is not None:
+                data[section] = existing.get(section, [])
+
+    tracer = configure_tracer()
+    configure_cache(enabled=not args.no_cache)
+    recorder = Recorder(args.record) if args.record else None
+    replay = ReplayServer(args.replay, parse_latency(args.latency)).start() if args.replay else None
+    configure_client(recorder=recorder, replay=replay, hedge=args.hedge)
+    if args.deadline is not None:
+        for source in SOURCES.values():
+            source.deadline = args.deadline or None
+    previous = existing if args.incremental else None
+    watermarks = compute_watermarks(previous) if previous is not None else {}
+    sync = None
+    succeeded = set()
     try:
-        bucket = get_supabase_bucket()
-        bucket_list = {f['name'] for f in bucket.list(options={'limit': 999999})}
-        create_img_folder()
+        with span('setup', 'phase'):
+            sync = BucketSync(lambda: open_bucket(replay, recorder))  # connects on the first image lookup
+            if args.reconcile_bucket:
+                sync.reconcile()
+                prune_bucket(sync, get_image_store())
+                sync.run()
+                return 0
+            create_img_folder()
 
         print('Scraping sources...')
 
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            futures = [
-                executor.submit(scrape_all_movies, data, 999, img_width, bucket, bucket_list),
-                executor.submit(scrape_all_tv_shows, data, 999, img_width, bucket, bucket_list),
-                executor.submit(scrape_books, data, content_limit, bucket, bucket_list),
-                executor.submit(scrape_spotify, data, content_limit, bucket, bucket_list),
-                executor.submit(scrape_github, data, content_limit),
-                executor.submit(scrape_videogames, data, bucket, bucket_list)
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as exc:
-                    log_warning(f'Source task failed: {exc}')
+        with span('scrape', 'phase'):
+            if args.async_mode:
+                import asyncio
+
+                from scraping.aio import scrape_async
+                succeeded = asyncio.run(scrape_async(data, previous, watermarks, sync, due))
+            else:
+                succeeded = scrape_threaded(data, previous, watermarks, sync, due)
     except Exception as exc:
         log_warning(f'Scraper setup failed: {exc}')
-
-    write_data(data)
-
-
-def scrape_all_movies(data, content_limit, img_width, bucket, bucket_list):
-    scrape_movies(data, content_limit, img_width, bucket, bucket_list)
-    scrape_cinema_movies(data, bucket, bucket_list)
-    scrape_fav_movies(data, bucket, bucket_list)
-
-
-def scrape_all_tv_shows(data, content_limit, img_width, bucket, bucket_list):
-    scrape_tv_shows(data, content_limit, img_width, bucket, bucket_list)
-    scrape_fav_tv_shows(data, bucket, bucket_list)
-
-
-def scrape_movies(data, content_limit, img_width, bucket, bucket_list):
-    plex_url: str = os.environ.get("PLEX_URL")
-    plex_metadata_url: str = os.environ.get("PLEX_METADATA_URL")
-    plex_user: str = os.environ.get("PLEX_USER")
-    plex_proxy_img: str = os.environ.get("PLEX_PROXY_IMG")
-
-    plex_json = requests.get(url=plex_url).json()
-    rows = plex_json['response']['data']['rows']
-
-    movies = [row for row in rows if row['media_type'] == 'movie' and row['user'] == plex_user]
-    for movie in movies[:content_limit]:
-        j = requests.get(plex_metadata_url + str(movie['rating_key'])).json()
-        if 'guids' in j['response']['data']:
-            guid = j['response']['data']['guids'][1].split('//')[1]
-            if not any(m['guid'] == guid for m in data['movies']):
-                slug = slugify(movie['title'])
-                img_url = plex_proxy_img + movie['thumb'] + '&width=' + str(img_width)
-                save_images(bucket, bucket_list, 'movie', slug, 'png', img_url)
-                data['movies'].append({
-                    'title': movie['title'],
-                    'guid': guid,
-                    'year': movie['year'],
-                    'img': f'movie_{slug}.png',
-                    'img_webp': f'movie_{slug}.webp' if exists(
-                        f'static/img/movie_{slug}.webp') else f'movie_{slug}.png',
-                    'last_watch': movie['last_watch'],
-                    'cinema': False,
-                    'is_favorite': False
-                })
-        else:
-            log_warning(f'Error fetching metadata: {j}')
-
-
-def scrape_cinema_movies(data, bucket, bucket_list):
-    d = feedparser.parse('https://letterboxd.com/n3d1117/rss/')
-    for lbx_list in ['🍿 Cinema', '🍿 Cinema 2', '🍿 Cinema 3']:  # due to rss limit. waiting for letterboxd apis to be available...
-        lbxd_cinema_lists = [item for item in d['entries'] if item['title'] == lbx_list]
-        if len(lbxd_cinema_lists) > 0:
-            lbxd_cinema_list = lbxd_cinema_lists[0]
-            cinema_movies_raw = re.findall("<li>(.*?)</li>", lbxd_cinema_list['summary'])
-            cinema_movies = []
-            for movie in cinema_movies_raw:
-                cinema_movies.append(
-                    {'title': movie.split('">')[1].split('</a>')[0], 'link': movie.split('href="')[1].split('"')[0]})
-            for movie in cinema_movies:
-                items = [item for item in d['entries'] if
-                         'letterboxd_filmtitle' in item and item['letterboxd_filmtitle'] == movie['title']]
-                if len(items) > 0:
-                    item = items[0]
-
-                    if not any(m['guid'] == movie['link'] for m in data['movies']):
-                        slug = slugify(item['letterboxd_filmtitle'])
-                        img_url = item['summary'].split('src="')[1].split('"')[0].replace('0-500-0-750', '0-230-0-345')
-                        save_images(bucket, bucket_list, 'movie', slug, 'jpg', img_url)
-                        data['movies'].append({
-                            'title': item['letterboxd_filmtitle'],
-                            'guid': movie['link'],
-                            'year': int(item['letterboxd_filmyear']),
-                            'img': f'movie_{slug}.jpg',
-                            'img_webp': f'movie_{slug}.webp' if exists(
-                                f'static/img/movie_{slug}.webp') else f'movie_{slug}.jpg',
-                            'last_watch': int(
-                                datetime.strptime(item['letterboxd_watcheddate'], "%Y-%m-%d").timestamp()),
-                            'cinema': True,
-                            'is_favorite': False
-                        })
-
-
-def scrape_fav_movies(data, bucket, bucket_list):
-    tmdb_api_key: str = os.environ.get("TMDB_API_KEY")
-    top_movies = requests.get(url="https://api.themoviedb.org/3/list/7112446?api_key=" + tmdb_api_key)
-    top_movies_json = top_movies.json()
-    for movie in top_movies_json['items']:
-        slug = slugify(movie['title'])
-        img_url = 'https://image.tmdb.org/t/p/w300' + movie['poster_path']
-        save_images(bucket, bucket_list, 'movie', slug, 'jpg', img_url)
-        data['movies'].append({
-            'title': movie['title'],
-            'guid': str(movie['id']),
-            'year': int(movie['release_date'].split('-')[0]),
-            'img': f'movie_{slug}.jpg',
-            'img_webp': f'movie_{slug}.webp' if exists(f'static/img/movie_{slug}.webp') else f'movie_{slug}.jpg',
-            'last_watch': int(datetime.strptime(movie['release_date'], "%Y-%m-%d").timestamp()),
-            'cinema': False,
-            'is_favorite': True
-        })
-
-
-def scrape_tv_shows(data, content_limit, img_width, bucket, bucket_list):
-    plex_url: str = os.environ.get("PLEX_URL")
-    plex_metadata_url: str = os.environ.get("PLEX_METADATA_URL")
-    plex_user: str = os.environ.get("PLEX_USER")
-    plex_proxy_img: str = os.environ.get("PLEX_PROXY_IMG")
-
-    plex_json = requests.get(url=plex_url).json()
-    rows = plex_json['response']['data']['rows']
-
-    tv_shows = [row for row in rows if row['media_type'] == 'episode' and row['user'] == plex_user]
-    unique_shows = []
-    unique_show_titles = []
-    episodes = {}
-    for show in tv_shows:
-        key = str(show['grandparent_rating_key'])
-
-        if show['grandparent_title'] not in unique_show_titles:
-            unique_show_titles.append(show['grandparent_title'])
-            unique_shows.append(show)
-            episodes[key] = []
-            episodes[key].append({
-                'episode': 'S' + str(show['parent_media_index']) + 'E' + str(show['media_index']),
-                'name': show['grandchild_title'],
-                'watched_on': show['last_watch']
-            })
-        else:
-            episodes[key].append({
-                'episode': 'S' + str(show['parent_media_index']) + 'E' + str(show['media_index']),
-                'name': show['grandchild_title'],
-                'watched_on': show['last_watch']
-            })
-    for show in unique_shows[:content_limit]:
-        j = requests.get(plex_metadata_url + str(show['rating_key'])).json()
-        if 'grandparent_guids' in j['response']['data']:
-            slug = slugify(show['grandparent_title'])
-            img_url = plex_proxy_img + show['thumb'] + '&width=' + str(img_width)
-            save_images(bucket, bucket_list, 'show', slug, 'png', img_url)
-            guid = j['response']['data']['grandparent_guids'][1].split('//')[1]
-            eps = episodes[str(show['grandparent_rating_key'])]
-            for ep in eps:
-                ep['parent_show_id'] = guid
-            data['shows'].append({
-                'title': show['grandparent_title'],
-                'guid': guid,
-                'ep': 'S' + str(show['parent_media_index']) + 'E' + str(show['media_index']),
-                'last_watch': show['last_watch'],
-                'img': f'show_{slug}.png',
-                'img_webp': f'show_{slug}.webp' if exists(f'static/img/show_{slug}.webp') else f'show_{slug}.png',
-                'episodes': eps,
-                'is_favorite': False
-            })
-
-
-def scrape_fav_tv_shows(data, bucket, bucket_list):
-    tmdb_api_key: str = os.environ.get("TMDB_API_KEY")
-    top_shows = requests.get(url="https://api.themoviedb.org/3/list/7112447?api_key=" + tmdb_api_key)
-    top_shows_json = top_shows.json()
-    for show in top_shows_json['items']:
-        slug = slugify(show['name'])
-        img_url = 'https://image.tmdb.org/t/p/w300' + show['poster_path']
-        save_images(bucket, bucket_list, 'show', slug, 'jpg', img_url)
-        data['shows'].append({
-            'title': show['name'],
-            'guid': str(show['id']),
-            'ep': show['first_air_date'].split('-')[0],
-            'img': f'show_{slug}.jpg',
-            'img_webp': f'show_{slug}.webp' if exists(f'static/img/show_{slug}.webp') else f'show_{slug}.jpg',
-            'last_watch': int(datetime.strptime(show['first_air_date'], "%Y-%m-%d").timestamp()),
-            'episodes': [],
-            'is_favorite': True
-        })
-
-
-def scrape_books(data, content_limit, bucket, bucket_list):
-    oku_url = 'https://oku.club/api/collections/'
-    reading = 'yjUNL'
-    read = 'xSQso'
-    # to_read='I0Ai5'
-    favorites = 'IPgqn'
-    f = requests.get(oku_url + favorites).json()
-    d = requests.get(oku_url + read).json()
-    d2 = requests.get(oku_url + reading).json()
-    # d3 = requests.get(oku_url + to_read).json()
-    for fav_book in f['books']:
-        slug = fav_book['slug']
-        save_images(bucket, bucket_list, 'book', slug, 'jpg', fav_book['thumbnail'])
-        data['books'].append({
-            'title': fav_book['title'],
-            'author': fav_book['authors'][0]['name'],
-            'url': 'https://oku.club/book/' + fav_book['slug'],
-            'img': f'book_{slug}.jpg',
-            'img_webp': f'book_{slug}.webp' if exists(f'static/img/book_{slug}.webp') else f'book_{slug}.jpg',
-            'added_at': int(datetime.strptime(fav_book['addedAt'], "%Y-%m-%d").timestamp()),
-            'is_favorite': True,
-            'reading': False
-        })
-    for book in (d['books'])[:content_limit]:
-        slug = book['slug']
-        save_images(bucket, bucket_list, 'book', slug, 'jpg', book['thumbnail'])
-        data['books'].append({
-            'title': book['title'],
-            'author': book['authors'][0]['name'],
-            'url': 'https://oku.club/book/' + book['slug'],
-            'img': f'book_{slug}.jpg',
-            'img_webp': f'book_{slug}.webp' if exists(f'static/img/book_{slug}.webp') else f'book_{slug}.jpg',
-            'added_at': int(datetime.strptime(book['addedAt'], "%Y-%m-%d").timestamp()),
-            'is_favorite': False,
-            'reading': False
-        })
-    for book in (d2['books'])[:content_limit]:
-        slug = book['slug']
-        save_images(bucket, bucket_list, 'book', slug, 'jpg', book['thumbnail'])
-        data['books'].append({
-            'title': book['title'],
-            'author': book['authors'][0]['name'],
-            'url': 'https://oku.club/book/' + book['slug'],
-            'img': f'book_{slug}.jpg',
-            'img_webp': f'book_{slug}.webp' if exists(f'static/img/book_{slug}.webp') else f'book_{slug}.jpg',
-            'added_at': int(datetime.strptime(book['addedAt'], "%Y-%m-%d").timestamp()),
-            'is_favorite': False,
-            'reading': True
-        })
-
-
-def scrape_spotify(data, content_limit, bucket, bucket_list):
-    spotify_client_id: str = os.environ.get("SPOTIFY_CLIENT_ID")
-    spotify_client_secret: str = os.environ.get("SPOTIFY_CLIENT_SECRET")
-    spotify_refresh_token: str = os.environ.get("SPOTIFY_REFRESH_TOKEN")
-    spotify_token_url = 'https://accounts.spotify.com/api/token'
-    spotify_base_url = 'https://api.spotify.com/v1/me/top/artists'
-    auth_header = base64.urlsafe_b64encode((spotify_client_id + ':' + spotify_client_secret).encode('ascii'))
-    headers = {'Content-Type': 'application/x-www-form-urlencoded',
-               'Authorization': 'Basic {}'.format(auth_header.decode('ascii'))}
-    res = requests.post(url=spotify_token_url,
-                        data={'grant_type': 'refresh_token', 'refresh_token': spotify_refresh_token},
-                        headers=headers).json()
-    if 'access_token' not in res:
-        log_warning(f'Error refreshing Spotify token: {res}')
+        if previous is not None:
+            log_warning('Keeping previous data for all sources')
+            data = {section: previous.get(section, []) for section in data}
+    if existing is not None:
+        for section in due - succeeded:
+            log_warning(f'Keeping previous {section}, it will be retried on the next run')
+            data[section] = existing.get(section, [])
+
+    with span('sync', 'phase'):
+        shutdown_pool()
+        if sync is not None:
+            try:
+                sync.run()
+                get_image_store().push(sync)
+            except Exception as exc:
+                log_warning(f'Bucket sync failed: {exc}')
+    with span('write', 'phase'):
+        get_image_store().save()
+        changed = write_data(data, args.compact)
+        if args.shards:  # unchanged shards are skipped, missing ones come back
+            try:
+                write_shards(data)
+            except OSError as exc:
+                log_warning(f'Failed to write data shards: {exc}')
+        state['watermarks'] = compute_watermarks(data)
+        record_runs(state, succeeded)
+        save_state(state)
+    get_client().print_stats()
+    get_client().close()
+    get_cache().print_stats()
+    print_image_stats()
+    tracer.print_summary()
+    tracer.write_report()
+    if args.trace:
+        tracer.write_chrome_trace(args.trace)
+    if recorder is not None:
+        recorder.save()
+    if replay is not None:
+        replay.stop()
+        replay.print_stats()
+    if not changed:
+        print('Scraper output did not change')
+    return 0 if changed else EXIT_NO_CHANGES
+
+
+def daemon(args):
+    """Keeps running the sources that are due, sleeping until the next one is"""
+    while True:
+        try:
+            if main(args) == 0 and args.on_change:
+                print(f'Running {args.on_change}...')
+                subprocess.run(args.on_change, shell=True)
+        except Exception:
+            log_warning(f'Scheduled run failed:\n{traceback.format_exc()}')
+        intervals = {source.name: source.refresh for source in select_sources(args.sources)}
+        delay = seconds_until_due(load_state(), intervals)
+        print(f'Next run in {delay / 60:.0f} minutes')
+        time.sleep(delay)
+
+
+def prune_bucket(sync, store):
+    """Queues the removal of the bucket files no stored image uses, like the unhashed names of older versions"""
+    store.pull(sync)
+    used = store.filenames()
+    if not used:  # without an image manifest every file would look unused
+        log_warning('No image manifest, not pruning the bucket')
         return
-    access_token = res['access_token']
-    url = spotify_base_url + '?{}'.format(parse.urlencode({'time_range': 'short_term', 'limit': content_limit}))
-    spotify_req = requests.get(url=url, headers={'Authorization': 'Bearer {}'.format(access_token)})
-    j = spotify_req.json()
-    for item in j['items']:
-        slug = slugify(item['name'])
-        image_url = item['images'][1]['url'] if len(item['images']) > 1 else 'https://upload.wikimedia.org/wikipedia/commons/5/50/Black_Wallpaper.jpg'
-        save_images(bucket, bucket_list, 'artist', slug, 'jpeg', image_url, square=True)
-        data['spotify'].append({
-            'name': item['name'],
-            'url': item['external_urls']['spotify'],
-            'followers': str(item['followers']['total']),
-            'img': f'artist_{slug}.jpeg',
-            'img_webp': f'artist_{slug}.webp' if exists(f'static/img/artist_{slug}.webp') else f'artist_{slug}.jpeg',
-        })
-
-
-def scrape_github(data, content_limit):
-    github_url = 'https://api.github.com/users/{}/repos?per_page=500'.format('n3d1117')
-    include = ['chatgpt-telegram-bot', 'appdb', 'stats-ios', 'cook']
-    exclude = ['CrackBot']
-    j = requests.get(github_url).json()
-    for i in include:
-        project = [p for p in j if p['name'] == i][0]
-        data['github'].append({
-            'name': project['name'],
-            'html_url': project['html_url'],
-            'description': project['description'],
-            'language': project['language'],
-            'stargazers_count': project['stargazers_count'],
-            'forks_count': project['forks_count'],
-        })
-    d = sorted(j, key=lambda item: item['stargazers_count'], reverse=True)
-    for project in [p for p in d if p['name'] not in exclude and p['name'] not in include][:content_limit]:
-        data['github'].append({
-            'name': project['name'],
-            'html_url': project['html_url'],
-            'description': project['description'],
-            'language': project['language'],
-            'stargazers_count': project['stargazers_count'],
-            'forks_count': project['forks_count'],
-        })
-
-
-def scrape_videogames(data, bucket, bucket_list):
-    igdb_client_id: str = os.environ.get("IGDB_CLIENT_ID")
-    igdb_client_secret: str = os.environ.get("IGDB_CLIENT_SECRET")
-    params = (
-        ('client_id', igdb_client_id),
-        ('client_secret', igdb_client_secret),
-        ('grant_type', 'client_credentials'),
-    )
-    response = requests.post('https://id.twitch.tv/oauth2/token', params=params)
-    access_token = response.json()['access_token']
-    headers = {
-        'Client-ID': igdb_client_id,
-        'Authorization': 'Bearer ' + access_token,
-        'Accept': 'application/json',
-    }
-    # if same year, most recent first
-    ids = ['154986', '43335', '732', '27081', '96209', '114287', '134101', '114285', '1020', '7331', '8837',
-           '4647', '4649', '4648', '10662', '96', '3136', '19560', '6036', '157446', '112875', '205780']
-    for id in ids:
-        d = 'fields first_release_date, cover.url, name, url; where id = ' + id + ';'
-        response = requests.post('https://api.igdb.com/v4/games', headers=headers, data=d).json()
-        if len(response) > 0:
-            response = response[0]
-            cover_url = response['cover']['url'].replace('t_thumb', 't_cover_big').replace('//', 'https://')
-            year = int(datetime.fromtimestamp(int(response['first_release_date']), UTC).strftime('%Y'))
-            slug = slugify(response['name'])
-            save_images(bucket, bucket_list, 'game', slug, 'jpg', cover_url)
-            data['videogames'].append({
-                'name': response['name'],
-                'url': response['url'],
-                'year': year,
-                'img': f'game_{slug}.jpg',
-                'img_webp': f'game_{slug}.webp' if exists(f'static/img/game_{slug}.webp') else f'game_{slug}.jpg',
-            })
-
-
-def get_supabase_bucket():
-    url: str = os.environ.get("SUPABASE_URL")
-    key: str = os.environ.get("SUPABASE_KEY")
-    bucket_name: str = os.environ.get("SUPABASE_BUCKET_NAME")
-    supabase: Client = create_client(url, key, options=ClientOptions(storage_client_timeout=STORAGE_TIMEOUT))
-    bucket = supabase.storage.from_(bucket_name)
-    return bucket
-
-
-def create_img_folder():
-    if not exists('static/img'):
-        os.makedirs('static/img')
-
-
-def write_data(data):
-    try:
-        with open('data/scraper.json', 'w') as f:
-            json.dump(data, f)
-        with open('static/data.json', 'w', encoding='utf8') as f:
-            json.dump(data, f)
-    except Exception as exc:
-        log_warning(f'Failed to write scraper output: {exc}')
+    unused = [filename for filename in sync.files if filename not in used]
+    print(f'{len(unused)} bucket files are not used by any stored image')
+    sync.queue_removal(unused)
 
 
-def download_file(url, path, retries=3, timeout=HTTP_TIMEOUT):
-    tmp_path = f'{path}.part'
+def open_bucket(replay, recorder):
+    bucket = replay.bucket if replay is not None else get_supabase_bucket()
+    return RecordingBucket(bucket, recorder) if recorder is not None else bucket
 
-    for attempt in range(1, retries + 1):
-        try:
-            response = requests.get(url, timeout=timeout)
-            response.raise_for_status()
-            with open(tmp_path, 'wb') as f:
-                f.write(response.content)
-            os.replace(tmp_path, path)
-            return
-        except requests.exceptions.RequestException as exc:
-            if exists(tmp_path):
-                os.remove(tmp_path)
-            if attempt == retries:
-                raise RuntimeError(f'Failed to download {url} after {retries} attempts') from exc
-            print(f'Download failed for {url} (attempt {attempt}/{retries}): {exc}. Retrying...')
-            time.sleep(attempt)
+
+def scrape_threaded(data, previous, watermarks, sync, sections):
+    """Runs the sources of `sections`, most expensive first, returns the sections that were scraped successfully"""
+    plex = PlexSource.from_env() if {'movies', 'shows'} & set(sections) else None
+    images = ImagePipeline(sync).start()
+    custom = {
+        'movies': (scrape_all_movies, plex, PLEX_CONTENT_LIMIT, IMG_WIDTH, images, previous, watermarks.get('movies')),
+        'shows': (scrape_all_tv_shows, plex, PLEX_CONTENT_LIMIT, IMG_WIDTH, images, previous, watermarks.get('shows')),
+    }
+    selected = by_cost(source for source in SOURCES.values() if source.name in sections)
+    succeeded = set()
+    try:
+        with ThreadPoolExecutor(max_workers=len(selected) or 1) as executor:
+            futures = {}
+            for source in selected:
+                source.apply_limits(get_client())
+                task = custom[source.name] if source.custom else (source.scrape, images, PENDING_IMAGES)
+                futures[executor.submit(run_source, data, previous, source, *task)] = source.name
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        succeeded.add(futures[future])
+                except Exception as exc:
+                    log_warning(f'Source task failed: {exc}')
+    finally:
+        with span('images', 'section'):
+            images.join()
+        images.print_stats()
+    return succeeded
 
 
-def upload_file(bucket, filename, path, bucket_list, retries=UPLOAD_RETRIES):
-    file_options = {'content-type': get_content_type(path), 'upsert': 'false'}
+def run_source(data, previous, source, func, *args):
+    """Runs a source task within the deadline of `source`, falling back to the previous data of its section if it
+    fails in incremental mode.
 
-    for attempt in range(1, retries + 1):
+    Returns whether the source was scraped, False when its previous data was kept.
+    """
+    section = source.name
+    with span(section, 'section') as s, budget(source.deadline):
         try:
-            with UPLOAD_SEMAPHORE:
-                bucket.upload(filename, os.path.abspath(path), file_options=file_options)
-            remember_bucket_file(bucket_list, filename)
-            return
-        except StorageException as exc:
-            if is_duplicate_storage_error(exc):
-                remember_bucket_file(bucket_list, filename)
-                return
-            if bucket_file_exists(bucket, filename):
-                remember_bucket_file(bucket_list, filename)
-                return
-            if attempt == retries:
-                raise RuntimeError(f'Failed to upload {filename} after {retries} attempts') from exc
-            print(f'Upload failed for {filename} (attempt {attempt}/{retries}): {exc}. Retrying...')
-            time.sleep(attempt)
-        except Exception as exc:
-            if bucket_file_exists(bucket, filename):
-                remember_bucket_file(bucket_list, filename)
-                return
-            if attempt == retries:
-                raise RuntimeError(f'Failed to upload {filename} after {retries} attempts') from exc
-            print(f'Upload failed for {filename} (attempt {attempt}/{retries}): {exc}. Retrying...')
-            time.sleep(attempt)
-
-
-def save_images(bucket, bucket_list, media_type, slug, ext, url, square=False):
-    img_folder = 'static/img'
-    orig_filename = f'{media_type}_{slug}.{ext}'
-    webp_filename = f'{media_type}_{slug}.webp'
-    orig_path = f'{img_folder}/{orig_filename}'
-    webp_path = f'{img_folder}/{webp_filename}'
-
-    try:
-        for filename, path in {orig_filename: orig_path, webp_filename: webp_path}.items():
-            if exists(path) and is_zero_byte_file(path):
-                print(f'Removing empty {filename}...')
-                os.remove(path)
-            if bucket_has_file(bucket_list, filename) and not valid_local_file(path):
-                print(f'Downloading {filename}...')
-                with open(path, 'wb+') as f:
-                    try:
-                        f.write(bucket.download(filename))
-                    except StorageException:
-                        pass
-
-        if not valid_local_file(orig_path):
-            print(f'Saving {orig_filename} locally...')
-            download_file(url, orig_path)
-            if square:
-                with open(orig_path, 'r+b') as f:
-                    with Image.open(f) as image:
-                        square_image(image, 320).save(orig_path, image.format)
-
-        if not valid_local_file(webp_path):
-            print(f'Saving {webp_filename} locally...')
-            subprocess.run(
-                ['cwebp', '-quiet', orig_filename, '-o', webp_filename],
-                cwd=img_folder,
-                check=True
-            )
-
-        for filename, path in {orig_filename: orig_path, webp_filename: webp_path}.items():
-            if valid_local_file(path) and not bucket_has_file(bucket_list, filename):
-                print(f'Uploading {filename}...')
-                upload_file(bucket, filename, path, bucket_list=bucket_list)
-    except Exception as exc:
-        log_warning(f'Image processing failed for {orig_filename}: {exc}')
+            func(data, *args)
+            return True
+        except Exception:
+            if previous is None:
+                raise
+            log_warning(f'Keeping previous {section} after failure:\n{traceback.format_exc()}')
+            s.outcome = 'previous data'
+            data[section] = previous.get(section, [])
+            return False
+
+
+@traced('source')
+def scrape_all_movies(data, plex, content_limit, img_width, images, previous=None, since=None):
+    movies = ItemIndex(data['movies'], 'guid')
+    scrape_movies(movies, plex, content_limit, img_width, images, since)
+    if previous is not None:
+        data['movies'] = merge_by_key(movies.items, plex_movies(previous['movies']), 'guid')[:content_limit]
+        movies = ItemIndex(data['movies'], 'guid')
+    scrape_cinema_movies(movies, images)
+    scrape_fav_movies(movies, images)
+
+
+@traced('source')
+def scrape_all_tv_shows(data, plex, content_limit, img_width, images, previous=None, since=None):
+    shows = ItemIndex(data['shows'], 'guid')
+    scrape_tv_shows(shows, plex, content_limit, img_width, images, since)
+    if previous is not None:
+        data['shows'] = merge_shows(shows.items, plex_shows(previous['shows']))[:content_limit]
+        shows = ItemIndex(data['shows'], 'guid')
+    scrape_fav_tv_shows(shows, images)
+
+
+@traced('source')
+def scrape_movies(movies, plex, content_limit, img_width, images, since=None):
+    rows = [row for row in plex.rows('movie') if since is None or row['last_watch'] > since][:content_limit]
+    metadata = plex.metadata(movie['rating_key'] for movie in rows)
+    for movie in rows:
+        j = metadata.get(str(movie['rating_key']))
+        if j is not None and 'guids' in j:
+            guid = plex_guid(j, 'guids')
+            if guid not in movies:
+                item = plex_movie_item(movie, guid, PENDING_IMAGES)
+                images.submit(item, 'movie', slugify(movie['title']), 'png', plex.image_url(movie['thumb'], img_width))
+                movies.append(item)
+        else:
+            log_warning(f'Error fetching metadata for {movie["rating_key"]}: {j}')
 
 
-def get_content_type(path):
-    ext = os.path.splitext(path)[1].lower()
-    return {
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.png': 'image/png',
-        '.webp': 'image/webp',
-    }.get(ext, 'application/octet-stream')
+@traced('source')
+def scrape_cinema_movies(movies, images):
+    import feedparser
 
+    d = feedparser.parse(get_cache().fetch(LETTERBOXD_RSS_URL, 'letterboxd'))
+    for item, link in cinema_movies(d):
+        if link not in movies:
+            movie = cinema_movie_item(item, link, PENDING_IMAGES)
+            images.submit(movie, 'movie', slugify(item['letterboxd_filmtitle']), 'jpg', cinema_image_url(item))
+            movies.append(movie)
 
-def is_duplicate_storage_error(exc):
-    message = str(exc)
-    return 'Duplicate' in message or '409' in message
 
+@traced('source')
+def scrape_fav_movies(movies, images):
+    tmdb_api_key: str = os.environ.get("TMDB_API_KEY")
+    top_movies_json = get_cache().fetch_json(TMDB_LIST_URL.format(TMDB_FAV_MOVIES, tmdb_api_key), 'tmdb')
+    for movie in top_movies_json['items']:
+        item = tmdb_movie_item(movie, PENDING_IMAGES)
+        images.submit(item, 'movie', slugify(movie['title']), 'jpg', TMDB_IMAGE_URL + movie['poster_path'])
+        movies.append(item)
+
+
+@traced('source')
+def scrape_tv_shows(shows, plex, content_limit, img_width, images, since=None):
+    tv_shows = [row for row in plex.rows('episode') if since is None or row['last_watch'] > since]
+    unique_shows, episodes = group_episodes(tv_shows)
+    unique_shows = unique_shows[:content_limit]
+    metadata = plex.metadata(show['rating_key'] for show in unique_shows)
+    for show in unique_shows:
+        j = metadata.get(str(show['rating_key']))
+        if j is not None and 'grandparent_guids' in j:
+            guid = plex_guid(j, 'grandparent_guids')
+            eps = episodes[str(show['grandparent_rating_key'])]
+            item = plex_show_item(show, guid, eps, PENDING_IMAGES)
+            slug = slugify(show['grandparent_title'])
+            images.submit(item, 'show', slug, 'png', plex.image_url(show['thumb'], img_width))
+            shows.append(item)
 
-def bucket_has_file(bucket_list, filename):
-    with BUCKET_FILES_LOCK:
-        return filename in bucket_list
 
+@traced('source')
+def scrape_fav_tv_shows(shows, images):
+    tmdb_api_key: str = os.environ.get("TMDB_API_KEY")
+    top_shows_json = get_cache().fetch_json(TMDB_LIST_URL.format(TMDB_FAV_SHOWS, tmdb_api_key), 'tmdb')
+    for show in top_shows_json['items']:
+        item = tmdb_show_item(show, PENDING_IMAGES)
+        images.submit(item, 'show', slugify(show['name']), 'jpg', TMDB_IMAGE_URL + show['poster_path'])
+        shows.append(item)
 
-def remember_bucket_file(bucket_list, filename):
-    if bucket_list is None:
-        return
-    with BUCKET_FILES_LOCK:
-        bucket_list.add(filename)
 
+def write_data(data, compact=False):
+    """Serializes `data` once and writes that same buffer to every output path that does not hold it yet,
+    along with the precomputed views of the shortcodes.
 
-def bucket_file_exists(bucket, filename):
+    Returns whether any file was written.
+    """
+    separators = (',', ':') if compact else None
     try:
-        return bucket.exists(filename)
-    except Exception:
+        content = json.dumps(data, default=encode_record, separators=separators).encode('utf8')
+        views = json.dumps(build_views(data), separators=separators).encode('utf8')
+    except Exception as exc:
+        log_warning(f'Failed to serialize scraper output: {exc}')
         return False
-
-
-def valid_local_file(path):
-    return exists(path) and not is_zero_byte_file(path)
-
-
-def is_zero_byte_file(path):
-    return exists(path) and os.path.getsize(path) == 0
+    changed = False
+    for path, buffer in [(path, content) for path in OUTPUT_PATHS] + [(VIEWS_PATH, views)]:
+        if read_local_file(path) == buffer:
+            continue
+        tmp_path = f'{path}.part'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer)
+            os.replace(tmp_path, path)
+            changed = True
+        except OSError as exc:
+            log_warning(f'Failed to write {path}: {exc}')
+    return changed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scrapes the data shown on the website')
+    parser.add_argument('--no-cache', action='store_true', help='ignore cached API responses and refetch everything')
+    parser.add_argument('--reconcile-bucket', action='store_true',
+                        help='rebuild the bucket manifest from a full listing of the bucket, remove the files no '
+                             'stored image uses and exit')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='run every source, lookup and transfer on a single asyncio event loop')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only scrape items newer than the previous data/scraper.json and merge them into it')
+    parser.add_argument('--sources', type=lambda value: [name.strip() for name in value.split(',') if name.strip()],
+                        metavar='NAMES', help=f'comma separated sources to run, of {", ".join(SOURCES)} '
+                                              '(default: all), the others keep their previous data')
+    parser.add_argument('--only-due', action='store_true',
+                        help='only scrape the sources whose refresh interval has passed, keep the others as they are')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, scraping each source whenever its refresh interval passes')
+    parser.add_argument('--on-change', metavar='CMD',
+                        help='with --daemon, shell command to run after a run that changed the output, e.g. ./build.sh')
+    parser.add_argument('--compact', action='store_true',
+                        help='write data/scraper.json and static/data.json without whitespace')
+    parser.add_argument('--shards', action='store_true',
+                        help='also write each section as sorted pages under static/data, with an index.json')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='time budget of every source, instead of the one for its cost (0: no deadline)')
+    parser.add_argument('--hedge', action='store_true',
+                        help="send a GET again when it takes longer than the host's p95 and use the first response")
+    parser.add_argument('--record', metavar='DIR',
+                        help='save every HTTP response and bucket call of this run as replay fixtures in DIR')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='serve every request from the fixtures in DIR instead of the real APIs and bucket')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='also export the spans of the run as a Chrome trace, to open in ui.perfetto.dev')
+    parser.add_argument('--latency', default='0', metavar='MS',
+                        help="delay of each replayed response in milliseconds, or 'recorded' (default: 0)")
+    args = parser.parse_args(argv)
+    try:
+        select_sources(args.sources)
+    except ValueError as exc:
+        parser.error(str(exc))
+    return args
 
 
 def log_warning(message):
     print(f'Warning: {message}')
 
 
-def slugify(text):
-    non_url_safe = ['"', '#', '$', '%', '&', '+', ',', '/', ':', ';', '=',
-                    '?', '@', '[', '\\', ']', '^', '`', '{', '|', '}', '~', "'", "(", ")"]
-    non_url_safe_regex = re.compile(r'[{}]'.format(''.join(re.escape(x) for x in non_url_safe)))
-    text = non_url_safe_regex.sub('', text).strip()
-    text = u'_'.join(re.split(r'\s+', text))
-    return unidecode(text.lower())
-
-
-# https://stackoverflow.com/a/65977483/6022481
-def square_image(image: Image, length: int) -> Image:
-    if image.size[0] == image.size[1]:
-        return image
-    elif image.size[0] < image.size[1]:
-        resized_image = image.resize((length, int(image.size[1] * (length / image.size[0]))))
-        required_loss = (resized_image.size[1] - length)
-        resized_image = resized_image.crop(
-            box=(0, required_loss / 2, length, resized_image.size[1] - required_loss / 2))
-        return resized_image
-    else:
-        resized_image = image.resize((int(image.size[0] * (length / image.size[1])), length))
-        required_loss = resized_image.size[0] - length
-        resized_image = resized_image.crop(
-            box=(required_loss / 2, 0, resized_image.size[0] - required_loss / 2, length))
-        return resized_image
-
-
 if __name__ == '__main__':
     load_dotenv()
+    args = parse_args()
     try:
-        main()
+        sys.exit(daemon(args) if args.daemon else main(args))
     except Exception:
         log_warning(f'Unexpected top-level failure:\n{traceback.format_exc()}')
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# Helpers shared by scraper.py
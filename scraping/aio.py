@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import time
+import traceback
+from urllib.parse import urlsplit
+
+import feedparser
+import httpx
+
+from scraping.cache import get_cache
+from scraping.deadline import bounded, budget, remaining
+from scraping.image_store import get_image_store, object_key
+from scraping.images import IMAGE_DIR, encode_variants, get_pool, image_variants, write_outputs
+from scraping.index import ItemIndex
+from scraping.incremental import merge_by_key, merge_shows, plex_movies, plex_shows
+from scraping.items import (IMG_WIDTH, LETTERBOXD_RSS_URL, PLEX_CONTENT_LIMIT, TMDB_FAV_MOVIES, TMDB_FAV_SHOWS,
+                            TMDB_IMAGE_URL, TMDB_LIST_URL, cinema_image_url, cinema_movie_item, cinema_movies,
+                            group_episodes, plex_guid, plex_movie_item, plex_show_item, slugify, tmdb_movie_item,
+                            tmdb_show_item)
+from scraping.media import (Download, conditional_headers, download_part_path, image_filenames, last_good_filenames,
+                            missing_variants, queue_transfers, record_image, resolve_name, resume_headers,
+                            valid_local_file)
+from scraping.net import (CHUNK_SIZE, DEFAULT_HOST_LIMIT, HOST_LIMITS, HTTP_BACKOFF, HTTP_RETRIES, HTTP_TIMEOUT,
+                          IDEMPOTENT_METHODS, RETRY_STATUSES, CircuitBreaker, HostStats, body_size, get_client,
+                          print_host_stats, retry_delay)
+from scraping.plex import PLEX_CONCURRENCY, PlexSource
+from scraping.sources import SOURCES, by_cost
+from scraping.sync import SYNC_CONCURRENCY
+from scraping.trace import span, traced
+
+ASYNC_CONCURRENCY = 32
+HANDSHAKE_EVENTS = ('connection.connect_tcp', 'connection.start_tls')
+
+
+class AsyncDeadlineExceeded(httpx.TimeoutException):
+    """Same as scraping.net.DeadlineExceeded"""
+
+
+class AsyncCircuitOpen(httpx.TransportError):
+    """Same as scraping.net.CircuitOpen"""
+
+
+class AsyncHttpClient:
+    """asyncio counterpart of scraping.net.HttpClient, with a global and a per-host concurrency cap"""
+
+    def __init__(self, concurrency=ASYNC_CONCURRENCY, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF, host_limits=None, default_host_limit=DEFAULT_HOST_LIMIT, recorder=None,
+                 replay=None, hedge=False):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.host_limits = dict(HOST_LIMITS if host_limits is None else host_limits)
+        self.default_host_limit = default_host_limit
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        transport = httpx.AsyncHTTPTransport(limits=limits)
+        if replay is not None:
+            transport = _RewriteTransport(transport, replay.rewrite)
+        hooks = {'response': [recorder.arecord_response]} if recorder is not None else {}
+        self._client = httpx.AsyncClient(timeout=timeout, follow_redirects=True, transport=transport,
+                                         event_hooks=hooks)
+        self._global = asyncio.Semaphore(concurrency)
+        self._semaphores = {}
+        self._stats = {}
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def request(self, method, url, retries=None, stream=False, retry_status=None, **kwargs):
+        """With `stream=True` the body is left unread, for the caller to iterate and `aclose`.
+
+        Retries and circuit breaker work like HttpClient.request.
+        """
+        host = urlsplit(url).hostname or ''
+        retries = self.retries if retries is None else retries
+        retry_status = method in IDEMPOTENT_METHODS if retry_status is None else retry_status
+        if isinstance(kwargs.get('data'), (str, bytes)):
+            kwargs['content'] = kwargs.pop('data')
+
+        with span(host, 'http', method=method, path=urlsplit(url).path) as s:
+            for attempt in range(1, retries + 1):
+                s.set(retries=attempt - 1)
+                self._check(host, url)
+                try:
+                    response = await self._send(host, method, url, stream, timeout=bounded(self.timeout), **kwargs)
+                except httpx.TransportError as exc:
+                    if attempt == retries:
+                        self.breaker.failure(url)
+                        raise
+                    await self._wait_before_retry(host, url, attempt, retries, exc)
+                    continue
+
+                if response.status_code in RETRY_STATUSES and retry_status and attempt < retries:
+                    await response.aclose()
+                    await self._wait_before_retry(host, url, attempt, retries, f'HTTP {response.status_code}',
+                                                  response.headers.get('Retry-After'))
+                    continue
+                if response.status_code in RETRY_STATUSES:
+                    self.breaker.failure(url)
+                else:
+                    self.breaker.success(url)
+                s.set(status=response.status_code, bytes=body_size(response, stream))
+                if response.status_code >= 400:
+                    s.outcome = f'HTTP {response.status_code}'
+                return response
+
+    async def fetch(self, url, source, method='GET', headers=None, data=None, ttl=None, **kwargs):
+        """Same as MetadataCache.fetch; `headers` may be a coroutine function"""
+        cache = get_cache()
+        key, entry, body = cache.lookup(url, source, method, data, ttl)
+        if body is not None:
+            return body
+
+        headers = dict((await headers() if callable(headers) else headers) or {})
+        headers.update(cache.validators(entry))
+        try:
+            response = await self.request(method, url, headers=headers, data=data, **kwargs)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except httpx.HTTPError as exc:
+            return cache.fallback(entry, source, exc)
+        return cache.complete(key, entry, source, response.status_code, response.headers, response.text)
+
+    async def fetch_json(self, url, source, **kwargs):
+        return json.loads(await self.fetch(url, source, **kwargs))
+
+    def set_host_limit(self, host, limit):
+        self.host_limits[host] = limit
+        self._semaphores.pop(host, None)
+
+    def print_stats(self):
+        print_host_stats(self._stats, self.breaker.open_hosts())
+
+    async def close(self):
+        await self._client.aclose()
+
+    def _host_semaphore(self, host):
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_host_limit))
+        return self._semaphores[host]
+
+    def _host_stats(self, host):
+        if host not in self._stats:
+            self._stats[host] = HostStats()
+        return self._stats[host]
+
+    def _check(self, host, url):
+        left = remaining()
+        if left is not None and left <= 0:
+            raise AsyncDeadlineExceeded(f'Deadline exceeded, not requesting {url}')
+        if not self.breaker.allow(url):
+            raise AsyncCircuitOpen(f'Circuit open for {urlsplit(url).netloc}, not requesting {url}')
+
+    async def _send(self, host, method, url, stream, **kwargs):
+        """Same as HttpClient._send, the slower of the two requests is cancelled"""
+        delay = self._hedge_delay(host, method, stream)
+        if delay is None:
+            return await self._send_once(host, method, url, stream, **kwargs)
+        sent = asyncio.Event()
+        first = asyncio.ensure_future(self._send_once(host, method, url, stream, sent, **kwargs))
+        await sent.wait()
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        second = asyncio.ensure_future(self._send_once(host, method, url, stream, **kwargs))
+        self._host_stats(host).hedges += 1
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if task is second:
+                        self._host_stats(host).hedges_won += 1
+                    return task.result()
+        return first.result()
+
+    async def _send_once(self, host, method, url, stream, sent=None, **kwargs):
+        async with self._host_semaphore(host), self._global:  # waiting on a capped host holds no global slot
+            if sent is not None:
+                sent.set()
+            start = time.perf_counter()
+            try:
+                request = self._client.build_request(method, url, extensions={'trace': self._tracer(host)}, **kwargs)
+                response = await self._client.send(request, stream=stream)
+            except httpx.TransportError:
+                self._record(host, time.perf_counter() - start, error=True)
+                raise
+            elapsed = time.perf_counter() - start
+        self._record(host, elapsed, body_size(response, stream), response.status_code not in RETRY_STATUSES)
+        return response
+
+    def _hedge_delay(self, host, method, stream):
+        if not self.hedge or method != 'GET' or stream:
+            return None
+        return self._host_stats(host).hedge_delay()
+
+    def _record(self, host, elapsed, size=0, answered=False, error=False):
+        s = self._host_stats(host)
+        s.requests += 1
+        s.elapsed += elapsed
+        if error:
+            s.errors += 1
+        if answered:
+            s.latencies.append(elapsed)
+        s.bytes += size
+
+    def _tracer(self, host):
+        started = {}
+
+        async def trace(event, info):
+            name, _, state = event.rpartition('.')
+            if name not in HANDSHAKE_EVENTS:
+                return
+            if state == 'started':
+                started[name] = time.perf_counter()
+            elif state == 'complete' and name in started:
+                s = self._host_stats(host)
+                s.handshake += time.perf_counter() - started.pop(name)
+                if name == 'connection.connect_tcp':
+                    s.connections += 1
+
+        return trace
+
+    async def _wait_before_retry(self, host, url, attempt, retries, reason, retry_after=None):
+        self._host_stats(host).retries += 1
+        delay = bounded(retry_delay(self.backoff, attempt, retry_after))
+        print(f'Request failed for {url} (attempt {attempt}/{retries}): {reason}. Retrying in {delay:.1f}s...')
+        await asyncio.sleep(delay)
+
+
+class _RewriteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport, rewrite):
+        self._transport = transport
+        self._rewrite = rewrite
+
+    async def handle_async_request(self, request):
+        request.url = httpx.URL(self._rewrite(str(request.url)))
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class AsyncScraper:
+    """Runs every source on one event loop.
+
+    Mirrors the threaded scrapers in scraper.py item for item, so both modes
+    produce the same data. Image encoding goes to the process pool through
+    `run_in_executor` and storage calls, which only have a blocking client, run
+    in worker threads bounded by a semaphore.
+    """
+
+    def __init__(self, sync, client=None):
+        self.sync = sync
+        self.client = client or AsyncHttpClient(recorder=get_client().recorder, replay=get_client().replay,
+                                                hedge=get_client().hedge)
+        self._plex_history = None
+        self._plex_metadata = {}
+        self._image_locks = {}
+        self._transfers = []
+        self._transfer_semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    @functools.cached_property
+    def plex(self):
+        """Only built once the movies or shows need it"""
+        plex = PlexSource.from_env()
+        self.client.set_host_limit(urlsplit(plex.metadata_url or '').hostname, PLEX_CONCURRENCY)
+        return plex
+
+    async def run(self, data, previous, watermarks, sections):
+        """Runs the sources of `sections`, most expensive first, returns the sections that were scraped successfully"""
+        custom = {
+            'movies': lambda: self.scrape_all_movies(data, previous, watermarks.get('movies')),
+            'shows': lambda: self.scrape_all_tv_shows(data, previous, watermarks.get('shows')),
+        }
+        selected = by_cost(source for source in SOURCES.values() if source.name in sections)
+        for source in selected:
+            source.apply_limits(self.client)
+        results = await asyncio.gather(*(
+            self.run_source(data, previous, source, custom[source.name] if source.custom else
+                            lambda source=source: source.ascrape(data, self.client, self.save_images))
+            for source in selected))
+        self.schedule_transfers()
+        await asyncio.gather(*self._transfers)
+        return {source.name for source, ok in zip(selected, results) if ok}
+
+    async def run_source(self, data, previous, source, scrape):
+        """Runs `scrape()` within the deadline of `source`, which here also cuts off whatever is still running"""
+        section = source.name
+        with span(section, 'section') as s, budget(source.deadline):
+            try:
+                async with asyncio.timeout(source.deadline):
+                    await scrape()
+                return True
+            except Exception as exc:
+                if previous is None:
+                    s.outcome = f'error: {type(exc).__name__}'
+                    print(f'Warning: Source task failed: {exc!r}')
+                    return False
+                print(f'Warning: Keeping previous {section} after failure:\n{traceback.format_exc()}')
+                s.outcome = 'previous data'
+                data[section] = previous.get(section, [])
+                return False
+
+    @traced('source')
+    async def scrape_all_movies(self, data, previous=None, since=None):
+        movies = ItemIndex(data['movies'], 'guid')
+        await self.scrape_movies(movies, since)
+        if previous is not None:
+            data['movies'] = merge_by_key(movies.items, plex_movies(previous['movies']), 'guid')[:PLEX_CONTENT_LIMIT]
+            movies = ItemIndex(data['movies'], 'guid')
+        await self.scrape_cinema_movies(movies)
+        await self.scrape_fav_movies(movies)
+
+    @traced('source')
+    async def scrape_all_tv_shows(self, data, previous=None, since=None):
+        shows = ItemIndex(data['shows'], 'guid')
+        await self.scrape_tv_shows(shows, since)
+        if previous is not None:
+            data['shows'] = merge_shows(shows.items, plex_shows(previous['shows']))[:PLEX_CONTENT_LIMIT]
+            shows = ItemIndex(data['shows'], 'guid')
+        await self.scrape_fav_tv_shows(shows)
+
+    @traced('source')
+    async def scrape_movies(self, movies, since=None):
+        rows = await self.plex_rows('movie')
+        rows = [row for row in rows if since is None or row['last_watch'] > since][:PLEX_CONTENT_LIMIT]
+        metadata = await self.plex_metadata(movie['rating_key'] for movie in rows)
+        selected = []
+        for movie in rows:
+            j = metadata.get(str(movie['rating_key']))
+            if j is not None and 'guids' in j:
+                guid = plex_guid(j, 'guids')
+                if movies.claim(guid):
+                    selected.append((movie, guid))
+            else:
+                print(f'Warning: Error fetching metadata for {movie["rating_key"]}: {j}')
+        images = await asyncio.gather(*(
+            self.save_images('movie', slugify(movie['title']), 'png', self.plex.image_url(movie['thumb'], IMG_WIDTH))
+            for movie, _ in selected))
+        movies.extend(plex_movie_item(movie, guid, img) for (movie, guid), img in zip(selected, images))
+
+    @traced('source')
+    async def scrape_cinema_movies(self, movies):
+        d = feedparser.parse(await self.client.fetch(LETTERBOXD_RSS_URL, 'letterboxd'))
+        selected = [(item, link) for item, link in cinema_movies(d) if movies.claim(link)]
+        images = await asyncio.gather(*(
+            self.save_images('movie', slugify(item['letterboxd_filmtitle']), 'jpg', cinema_image_url(item))
+            for item, _ in selected))
+        movies.extend(cinema_movie_item(item, link, img) for (item, link), img in zip(selected, images))
+
+    @traced('source')
+    async def scrape_fav_movies(self, movies):
+        url = TMDB_LIST_URL.format(TMDB_FAV_MOVIES, os.environ.get("TMDB_API_KEY"))
+        favorites = (await self.client.fetch_json(url, 'tmdb'))['items']
+        images = await asyncio.gather(*(
+            self.save_images('movie', slugify(movie['title']), 'jpg', TMDB_IMAGE_URL + movie['poster_path'])
+            for movie in favorites))
+        movies.extend(tmdb_movie_item(movie, img) for movie, img in zip(favorites, images))
+
+    @traced('source')
+    async def scrape_tv_shows(self, shows, since=None):
+        rows = await self.plex_rows('episode')
+        unique_shows, episodes = group_episodes([row for row in rows if since is None or row['last_watch'] > since])
+        unique_shows = unique_shows[:PLEX_CONTENT_LIMIT]
+        metadata = await self.plex_metadata(show['rating_key'] for show in unique_shows)
+        selected = [(show, metadata[str(show['rating_key'])]) for show in unique_shows
+                    if 'grandparent_guids' in metadata.get(str(show['rating_key']), {})]
+        images = await asyncio.gather(*(
+            self.save_images('show', slugify(show['grandparent_title']), 'png',
+                             self.plex.image_url(show['thumb'], IMG_WIDTH))
+            for show, _ in selected))
+        for (show, j), img in zip(selected, images):
+            eps = episodes[str(show['grandparent_rating_key'])]
+            shows.append(plex_show_item(show, plex_guid(j, 'grandparent_guids'), eps, img))
+
+    @traced('source')
+    async def scrape_fav_tv_shows(self, shows):
+        url = TMDB_LIST_URL.format(TMDB_FAV_SHOWS, os.environ.get("TMDB_API_KEY"))
+        favorites = (await self.client.fetch_json(url, 'tmdb'))['items']
+        images = await asyncio.gather(*(
+            self.save_images('show', slugify(show['name']), 'jpg', TMDB_IMAGE_URL + show['poster_path'])
+            for show in favorites))
+        shows.extend(tmdb_show_item(show, img) for show, img in zip(favorites, images))
+
+    async def plex_rows(self, media_type):
+        if self._plex_history is None:
+            self._plex_history = asyncio.ensure_future(self.client.get(self.plex.history_url))
+        plex_json = (await self._plex_history).json()
+        return [row for row in plex_json['response']['data']['rows']
+                if row['user'] == self.plex.user and row['media_type'] == media_type]
+
+    async def plex_metadata(self, rating_keys):
+        keys = [str(k) for k in rating_keys]
+        for key in keys:
+            if key not in self._plex_metadata:
+                self._plex_metadata[key] = asyncio.ensure_future(self._fetch_plex_metadata(key))
+        results = await asyncio.gather(*(self._plex_metadata[key] for key in keys))
+        return {key: data for key, data in zip(keys, results) if data is not None}
+
+    async def _fetch_plex_metadata(self, rating_key):
+        try:
+            j = await self.client.fetch_json(self.plex.metadata_url + rating_key, 'plex_metadata')
+            return j['response']['data']
+        except Exception as exc:
+            print(f'Warning: Error fetching metadata for {rating_key}: {exc}')
+            return None
+
+    async def save_images(self, media_type, slug, ext, url, square=False):
+        """Same as the stages of ImagePipeline, run as one coroutine per image"""
+        store = get_image_store()
+        if not store.pulled:  # the first lookup loads the bucket manifests, keep that off the event loop
+            await asyncio.to_thread(store.pull, self.sync)
+        orig_filename = f'{media_type}_{slug}.{ext}'
+
+        downloads = []
+        try:
+            source, entry = store.lookup(url)
+            fetched = None
+            if entry is None:
+                print(f'Saving {orig_filename} locally...')
+                fetched = await self.download(url)
+            elif not store.is_fresh(source):
+                fetched = await self.download(url, headers=conditional_headers(source))
+                if fetched.status == 304:
+                    store.touch(url)
+                    fetched = None
+
+            if fetched is not None:
+                downloads.append(fetched)
+            digest = fetched.digest if fetched is not None else source['key'].split(':', 1)[1]
+            async with self._image_lock(object_key(media_type, digest)):
+                name = resolve_name(store, media_type, slug, digest, entry if fetched is None else None)
+                variants = image_variants(name, ext)
+                missing = missing_variants(self.sync, variants)
+                placeholder = store.placeholder(object_key(media_type, digest))
+                if missing or placeholder is None:
+                    if fetched is not None:
+                        source_path = fetched.path
+                    else:
+                        source_path = await self._local_source(variants[0].filename, url, downloads)
+                    with span('encode', 'image', variants=len(missing)) as s:
+                        outputs, preview, elapsed = await asyncio.get_running_loop().run_in_executor(
+                            get_pool(), encode_variants, source_path, missing, square, placeholder is None)
+                        written = write_outputs(source_path, missing, outputs, elapsed, IMAGE_DIR)
+                        s.set(bytes=written, worker_time=round(elapsed, 4))
+                    placeholder = placeholder or preview
+                queue_transfers(self.sync, variants)
+                self.schedule_transfers()
+                if fetched is not None:
+                    record_image(store, self.sync, url, media_type, slug, digest, name, variants, fetched.size,
+                                 fetched.headers)
+                store.set_placeholder(object_key(media_type, digest), placeholder)
+            return image_filenames(self.sync, name, ext, placeholder)
+        except Exception as exc:
+            print(f'Warning: Image processing failed for {orig_filename}: {exc}')
+            return last_good_filenames(store, self.sync, url, media_type, slug, ext)
+        finally:
+            for d in downloads:
+                d.discard()
+
+    async def _local_source(self, filename, url, downloads):
+        """Same as ImagePipeline._local_source"""
+        path = f'{IMAGE_DIR}/{filename}'
+        if not valid_local_file(path) and filename in self.sync:
+            await asyncio.to_thread(self.sync.download_to, filename, path)
+        if valid_local_file(path):
+            return path
+        downloads.append(await self.download(url))
+        return downloads[-1].path
+
+    async def download(self, url, headers=None):
+        """Same as scraping.media.download, over the async client"""
+        tmp_path = download_part_path()
+        try:
+            return await self._stream_to(url, tmp_path, headers)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _stream_to(self, url, tmp_path, headers):
+        retries = self.client.retries
+        written, validator = 0, None
+        with span('download', 'image') as s:
+            for attempt in range(1, retries + 1):
+                try:
+                    response = await self.client.get(url, stream=True,
+                                                     headers=resume_headers(headers, written, validator))
+                except httpx.HTTPError as exc:
+                    raise RuntimeError(f'Failed to download {url} after {retries} attempts') from exc
+                try:
+                    if response.status_code == 304:
+                        return Download(304, response.headers)
+                    response.raise_for_status()
+                    if not written or response.status_code != 206:
+                        written, sha256 = 0, hashlib.sha256()
+                        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                    with open(tmp_path, 'ab' if written else 'wb') as f:
+                        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                            f.write(chunk)
+                            sha256.update(chunk)
+                            written += len(chunk)
+                except httpx.HTTPStatusError as exc:
+                    raise RuntimeError(f'Failed to download {url}: {exc}') from exc
+                except httpx.HTTPError as exc:
+                    if attempt == retries:
+                        raise RuntimeError(f'Failed to download {url} after {retries} attempts') from exc
+                    print(f'Download of {url} interrupted after {written} bytes (attempt {attempt}/{retries}): '
+                          f'{exc}. Resuming...')
+                    continue
+                finally:
+                    await response.aclose()
+                path = tmp_path.removesuffix('.part')
+                os.replace(tmp_path, path)
+                s.set(bytes=written, status=response.status_code)
+                return Download(response.status_code, response.headers, path, written, sha256.hexdigest())
+
+    def schedule_transfers(self):
+        """Starts the queued bucket transfers right away instead of waiting for the end of the run"""
+        downloads, uploads = self.sync.take_queued()
+        for name, path in downloads.items():
+            self._transfers.append(asyncio.ensure_future(self._transfer(self.sync.download_to, name, path)))
+        for name, path in uploads.items():
+            self._transfers.append(asyncio.ensure_future(self._transfer(self.sync.upload_from, name, path)))
+
+    async def _transfer(self, func, name, path):
+        async with self._transfer_semaphore:
+            try:
+                await asyncio.to_thread(func, name, path)
+            except Exception as exc:
+                print(f'Warning: Sync failed for {name}: {exc}')
+
+    def _image_lock(self, key):
+        if key not in self._image_locks:
+            self._image_locks[key] = asyncio.Lock()
+        return self._image_locks[key]
+
+
+async def scrape_async(data, previous, watermarks, sync, sections):
+    scraper = AsyncScraper(sync)
+    start = time.perf_counter()
+    try:
+        succeeded = await scraper.run(data, previous, watermarks, sections)
+    finally:
+        await scraper.client.close()
+    print(f'Async scrape took {time.perf_counter() - start:.2f}s')
+    scraper.client.print_stats()
+    return succeeded
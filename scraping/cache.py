@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from scraping.net import get_client
+
+CACHE_DIR = '.cache/scraper'
+HOUR = 60 * 60
+DAY = 24 * HOUR
+CACHE_TTLS = {
+    'tmdb': DAY,
+    'igdb': 7 * DAY,
+    'plex_metadata': 30 * DAY,
+    'oku': 6 * HOUR,
+    'github': 6 * HOUR,
+    'letterboxd': HOUR,
+}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class MetadataCache:
+    """On-disk cache of source API responses, one JSON file per request.
+
+    Fresh entries are served without touching the network, stale ones are
+    revalidated with `If-None-Match`/`If-Modified-Since` when the API returned
+    validators. When `enabled` is False every request goes to the network, but
+    responses are still stored for the next run.
+    """
+
+    def __init__(self, path=CACHE_DIR, enabled=True, ttls=None):
+        self.path = path
+        self.enabled = enabled
+        self.ttls = dict(CACHE_TTLS if ttls is None else ttls)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def fetch_json(self, url, source, **kwargs):
+        return json.loads(self.fetch(url, source, **kwargs))
+
+    def fetch(self, url, source, method='GET', headers=None, data=None, ttl=None, **kwargs):
+        """Returns the response body as text. `headers` may be a callable, evaluated only on a network request"""
+        key, entry, body = self.lookup(url, source, method, data, ttl)
+        if body is not None:
+            return body
+
+        headers = dict((headers() if callable(headers) else headers) or {})
+        headers.update(self.validators(entry))
+        try:
+            response = get_client().request(method, url, headers=headers, data=data, **kwargs)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except requests.exceptions.RequestException as exc:
+            return self.fallback(entry, source, exc)
+        return self.complete(key, entry, source, response.status_code, response.headers, response.text)
+
+    def lookup(self, url, source, method='GET', data=None, ttl=None):
+        """Returns (key, stored entry, body if the entry is still fresh)"""
+        ttl = self.ttls.get(source, 0) if ttl is None else ttl
+        key = cache_key(method, url, data)
+        entry = self._load(key)
+        if self.enabled and entry is not None and time.time() - entry['stored_at'] < ttl:
+            self._count(source, 'hits')
+            return key, entry, entry['body']
+        return key, entry, None
+
+    def validators(self, entry):
+        headers = {}
+        if self.enabled and entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def complete(self, key, entry, source, status_code, headers, text):
+        """Stores a successful (or 304) response and returns the body to use"""
+        if status_code == 304 and entry is not None:
+            self._count(source, 'revalidated')
+            entry['stored_at'] = time.time()
+            self._store(key, entry)
+            return entry['body']
+        self._count(source, 'misses')
+        self._store(key, {
+            'stored_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'body': text,
+        })
+        return text
+
+    def fallback(self, entry, source, exc):
+        if entry is None:
+            raise exc
+        self._count(source, 'stale')
+        print(f'Warning: Using stale {source} response after request failure: {exc}')
+        return entry['body']
+
+    def print_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        if not stats:
+            return
+        print('Cache stats:')
+        for source, counts in sorted(stats.items()):
+            print(f'  {source}: ' + ', '.join(f'{count} {kind}' for kind, count in sorted(counts.items())))
+
+    def _count(self, source, kind):
+        with self._lock:
+            counts = self._stats.setdefault(source, {})
+            counts[kind] = counts.get(kind, 0) + 1
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], f'{key}.json')
+
+    def _load(self, key):
+        try:
+            with open(self._entry_path(key), encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, key, entry):
+        path = self._entry_path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.part'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f'Warning: Failed to write cache entry {key}: {exc}')
+
+
+def cache_key(method, url, data=None):
+    body = data if isinstance(data, (str, bytes)) else json.dumps(data, sort_keys=True)
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    return hashlib.sha256(method.encode('ascii') + b' ' + url.encode('utf8') + b'\n' + body).hexdigest()
+
+
+def configure_cache(**kwargs):
+    global _cache
+    with _cache_lock:
+        _cache = MetadataCache(**kwargs)
+        return _cache
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetadataCache()
+        return _cache
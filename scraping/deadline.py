@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import time
+from contextlib import contextmanager
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+@contextmanager
+def budget(seconds):
+    """Gives the calls made inside at most `seconds` in total, or less if an enclosing budget ends sooner.
+
+    The deadline follows the context like trace spans do, so asyncio tasks
+    started inside inherit it; threads get it through `carry`.
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and (deadline is None or current < deadline):
+        deadline = current
+    with until(deadline):
+        yield deadline
+
+
+@contextmanager
+def until(deadline):
+    """Runs with the deadline returned by `current_deadline` somewhere else, e.g. in another thread"""
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+def remaining():
+    """Seconds left before the current deadline, None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def bounded(timeout):
+    """`timeout`, shortened to what is left of the current deadline"""
+    left = remaining()
+    return timeout if left is None else max(min(timeout, left), 0)
+
+
+def carry(func):
+    """`func` running with the deadline of the caller, for thread pool workers"""
+    deadline = current_deadline()
+
+    def run(*args, **kwargs):
+        with until(deadline):
+            return func(*args, **kwargs)
+
+    return run
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import requests
+
+from scraping.cache import get_cache
+
+IGDB_GAMES_URL = 'https://api.igdb.com/v4/games'
+IGDB_PAGE_LIMIT = 500  # max `limit` accepted by the API
+IGDB_GAME_FIELDS = 'first_release_date, cover.url, name, url'
+
+
+def fetch_games(ids, headers, fields=IGDB_GAME_FIELDS, page_size=IGDB_PAGE_LIMIT, url=IGDB_GAMES_URL):
+    """Resolves game ids with one query per page, returns (games in `ids` order, unresolved ids).
+
+    `headers` may be a callable so that the auth token is only requested when a page is not cached.
+    """
+    found = {}
+    for page, query in game_queries(ids, fields, page_size):
+        try:
+            games = get_cache().fetch_json(url, 'igdb', method='POST', headers=headers, data=query,
+                                           retry_status=True)  # a read-only query, safe to send again
+        except (requests.exceptions.RequestException, ValueError) as exc:
+            print(f'Warning: IGDB query for {len(page)} games failed: {exc}')
+            continue
+        for game in games:
+            found[str(game['id'])] = game
+    return order_games(ids, found)
+
+
+def game_queries(ids, fields=IGDB_GAME_FIELDS, page_size=IGDB_PAGE_LIMIT):
+    """Returns (page of ids, Apicalypse query) for every page of at most `page_size` distinct ids"""
+    ids = list(dict.fromkeys(str(i) for i in ids))
+    pages = [ids[start:start + page_size] for start in range(0, len(ids), page_size)]
+    return [(page, f'fields id, {fields}; where id = ({",".join(page)}); limit {len(page)};') for page in pages]
+
+
+def order_games(ids, found):
+    ids = list(dict.fromkeys(str(i) for i in ids))
+    return [found[i] for i in ids if i in found], [i for i in ids if i not in found]
+
+
+def igdb_headers(client_id, access_token):
+    return {
+        'Client-ID': client_id,
+        'Authorization': 'Bearer ' + access_token,
+        'Accept': 'application/json',
+    }
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_PATH = '.cache/scraper/images.json'
+BUCKET_MANIFEST = 'images.json'  # copy in the bucket, for builds that start without .cache
+REVALIDATE_AFTER = 7 * 24 * 60 * 60
+HASH_PREFIX_LENGTH = 12
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class ImageStore:
+    """Manifest of downloaded images, keyed by source URL and by content hash.
+
+    Files are named `{media_type}_{slug}_{hash}` so that a changed poster gets
+    new files, two titles with the same slug no longer overwrite each other and
+    identical images are only encoded and uploaded once.
+
+    The manifest is kept in .cache and, through `pull` and `push`, next to the
+    bucket manifest, so that a fresh build resolves known URLs to the files in
+    the bucket instead of downloading every image again to learn its hash.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, revalidate_after=REVALIDATE_AFTER):
+        self.path = path
+        self.revalidate_after = revalidate_after
+        self.sources = {}  # url -> {'key', 'etag', 'last_modified', 'checked_at'}
+        self.objects = {}  # '{media_type}:{sha256}' -> {'name', 'variants', 'slug', 'url', 'size', 'placeholder'}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pull_lock = threading.Lock()
+        self._pulled = False
+        self._unpushed = False  # changed since it was pulled from the bucket
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.sources = manifest.get('sources', {})
+        self.objects = manifest.get('objects', {})
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            manifest = {'sources': self.sources, 'objects': self.objects}
+            self._dirty = False
+        tmp_path = f'{self.path}.part'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(manifest, f, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            print(f'Warning: Failed to save image manifest: {exc}')
+
+    @property
+    def pulled(self):
+        return self._pulled
+
+    def pull(self, sync):
+        """Merges the copy in the bucket into this manifest, once per run; sources revalidated last win"""
+        if self._pulled:
+            return
+        with self._pull_lock:
+            if self._pulled:
+                return
+            sync.ensure_loaded()
+            remote = sync.read_json(BUCKET_MANIFEST) if sync.available else None
+            remote = remote or {'sources': {}, 'objects': {}}
+            with self._lock:
+                for url, source in remote['sources'].items():
+                    local = self.sources.get(url)
+                    if local is None or source['checked_at'] > local['checked_at']:
+                        self.sources[url] = source
+                        self._dirty = True
+                for key, entry in remote['objects'].items():
+                    local = self.objects.get(key)
+                    if local is None or local.get('placeholder') is None and entry.get('placeholder') is not None:
+                        self.objects[key] = entry
+                        self._dirty = True
+                self._unpushed = self.sources != remote['sources'] or self.objects != remote['objects']
+            self._pulled = True
+
+    def push(self, sync):
+        """Saves the manifest to the bucket if it changed since `pull`"""
+        with self._lock:
+            if not self._pulled or not self._unpushed or not sync.available:
+                return
+            manifest = {'sources': dict(self.sources), 'objects': dict(self.objects)}
+            self._unpushed = False
+        sync.write_json(BUCKET_MANIFEST, manifest)
+
+    def lookup(self, url):
+        """Returns (source entry, object entry) for a known `url`, or (None, None)"""
+        with self._lock:
+            source = self.sources.get(url)
+            if source is None or source['key'] not in self.objects:
+                return None, None
+            return dict(source), self.objects[source['key']]
+
+    def is_fresh(self, source):
+        return time.time() - source['checked_at'] < self.revalidate_after
+
+    def touch(self, url):
+        with self._lock:
+            if url in self.sources:
+                self.sources[url]['checked_at'] = time.time()
+                self._dirty = self._unpushed = True
+
+    def find(self, media_type, digest):
+        with self._lock:
+            return self.objects.get(object_key(media_type, digest))
+
+    def record(self, url, media_type, slug, digest, name, variants, size, etag=None, last_modified=None):
+        """Points `url` at the object, returns the files of the object it pointed at before if no URL uses it now"""
+        key = object_key(media_type, digest)
+        with self._lock:
+            previous = self.sources.get(url, {}).get('key')
+            self.objects[key] = {**self.objects.get(key, {}), 'name': name, 'variants': variants, 'slug': slug,
+                                 'url': url, 'size': size}
+            self.sources[url] = {'key': key, 'etag': etag, 'last_modified': last_modified,
+                                 'checked_at': time.time()}
+            self._dirty = self._unpushed = True
+            if previous in (None, key) or any(source['key'] == previous for source in self.sources.values()):
+                return []
+            return [f for f in self.objects.pop(previous, {}).get('variants', []) if f not in variants]
+
+    def filenames(self):
+        """Files of every stored object"""
+        with self._lock:
+            return {filename for entry in self.objects.values() for filename in entry['variants']}
+
+    def placeholder(self, key):
+        with self._lock:
+            return self.objects.get(key, {}).get('placeholder')
+
+    def set_placeholder(self, key, placeholder):
+        with self._lock:
+            if key in self.objects and self.objects[key].get('placeholder') != placeholder:
+                self.objects[key]['placeholder'] = placeholder
+                self._dirty = self._unpushed = True
+
+
+def object_key(media_type, digest):
+    return f'{media_type}:{digest}'
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def image_name(media_type, slug, digest):
+    return f'{media_type}_{slug}_{digest[:HASH_PREFIX_LENGTH]}'
+
+
+def get_image_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import base64
+import io
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from scraping.trace import span
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+IMAGE_DIR = 'static/img'
+WEBP_QUALITY = 75  # same as the cwebp default
+AVIF_QUALITY = 50
+IMAGE_AVIF = False  # needs Pillow >= 11.2 or pillow-avif-plugin
+IMAGE_WIDTHS = (80, 160)  # 1x and 2x of the covers, which the templates show at most 120px high
+PLACEHOLDER_WIDTH = 16  # blurred preview inlined in the item as a data URI
+PLACEHOLDER_QUALITY = 40
+SQUARE_SIZE = 320
+PIL_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF'}
+
+_pool = None
+_pool_lock = threading.Lock()
+_stats = []
+_stats_lock = threading.Lock()
+
+
+class ImageVariant:
+    def __init__(self, filename, fmt, width=None):
+        self.filename = filename
+        self.format = fmt  # 'orig' keeps the format of the downloaded image
+        self.width = width
+
+
+def image_variants(name, ext):
+    """Every file the pipeline produces for the image called `name`"""
+    variants = [ImageVariant(f'{name}.{ext}', 'orig'), ImageVariant(f'{name}.webp', 'webp')]
+    if avif_supported():
+        variants.append(ImageVariant(f'{name}.avif', 'avif'))
+    for width in IMAGE_WIDTHS:
+        variants.append(ImageVariant(f'{name}-{width}w.{ext}', 'orig', width))
+        variants.append(ImageVariant(f'{name}-{width}w.webp', 'webp', width))
+    return variants
+
+
+def avif_supported():
+    if not IMAGE_AVIF:
+        return False
+    from PIL import Image
+
+    try:
+        import pillow_avif  # noqa: F401, registers the AVIF plugin on older Pillow versions
+    except ImportError:
+        pass
+    return 'AVIF' in Image.SAVE
+
+
+def write_variants(source, variants, square=False, img_folder=IMAGE_DIR, placeholder=False):
+    """Decodes the image file `source` once in a worker process and writes the requested variants to `img_folder`.
+
+    Returns the placeholder data URI when `placeholder` is set, else None.
+    """
+    with span('encode', 'image', variants=len(variants)) as s:
+        outputs, preview, elapsed = get_pool().submit(encode_variants, source, variants, square, placeholder).result()
+        written = write_outputs(source, variants, outputs, elapsed, img_folder)
+        s.set(bytes=written, worker_time=round(elapsed, 4))
+    return preview
+
+
+def write_outputs(source, variants, outputs, elapsed, img_folder=IMAGE_DIR):
+    """Writes the encoded `outputs` next to copies of `source` for the variants that are the file as is.
+
+    Returns the number of bytes written.
+    """
+    sizes = {}
+    for filename, content in outputs.items():
+        path = os.path.join(img_folder, filename)
+        tmp_path = f'{path}.part'
+        if content is None:
+            shutil.copyfile(source, tmp_path)
+        else:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+        os.replace(tmp_path, path)
+        sizes[filename] = os.path.getsize(path)
+    if not outputs:
+        return 0
+
+    name = variants[0].filename.rsplit('.', 1)[0]
+    source_size = os.path.getsize(source)
+    print(f'Encoded {name} in {elapsed * 1000:.0f}ms: ' +
+          ', '.join(f'{f} {size / 1024:.1f} KiB ({saving(source_size, size)})' for f, size in sizes.items()))
+    with _stats_lock:
+        _stats.append((name, elapsed, source_size, sizes))
+    return sum(sizes.values())
+
+
+def encode_variants(source, variants, square=False, placeholder=False):
+    """Runs in the process pool, returns ({filename: bytes or None to copy `source`}, placeholder, seconds spent)"""
+    from PIL import Image  # only the workers decode images, the scraper itself never needs Pillow
+
+    start = time.perf_counter()
+    with Image.open(source) as image_file:
+        image_file.load()
+        source_format = image_file.format
+        image = square_image(image_file, SQUARE_SIZE) if square else image_file
+
+        outputs = {}
+        for variant in variants:
+            resized = image
+            if variant.width is not None and variant.width < image.size[0]:
+                height = round(image.size[1] * variant.width / image.size[0])
+                resized = image.resize((variant.width, height), Image.LANCZOS)
+            if variant.format == 'orig' and resized is image_file:
+                outputs[variant.filename] = None
+            elif variant.format == 'orig':
+                outputs[variant.filename] = encode(resized, source_format)
+            else:
+                outputs[variant.filename] = encode(resized, PIL_FORMATS[variant.format])
+        preview = placeholder_uri(image) if placeholder else None
+    return outputs, preview, time.perf_counter() - start
+
+
+def placeholder_uri(image):
+    """A few hundred bytes of blurred WebP that pages can show until the cover loads"""
+    from PIL import Image, ImageFilter
+
+    height = max(1, round(image.size[1] * PLACEHOLDER_WIDTH / image.size[0]))
+    small = image.convert('RGB').resize((PLACEHOLDER_WIDTH, height), Image.BILINEAR)
+    small = small.filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    small.save(buffer, 'WEBP', quality=PLACEHOLDER_QUALITY)
+    return 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def encode(image, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'WEBP':
+        image.save(buffer, fmt, quality=WEBP_QUALITY, method=4)
+    elif fmt == 'AVIF':
+        image.save(buffer, fmt, quality=AVIF_QUALITY)
+    elif fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image.convert('RGB').save(buffer, fmt)
+    else:
+        image.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def saving(original, encoded):
+    if original == 0:
+        return 'n/a'
+    return f'{(encoded - original) / original:+.0%}'
+
+
+def print_image_stats():
+    with _stats_lock:
+        stats = list(_stats)
+    if not stats:
+        return
+    total = sum(elapsed for _, elapsed, _, _ in stats)
+    source_bytes = sum(size for _, _, size, _ in stats)
+    webp_bytes = sum(size for *_, outputs in stats for f, size in outputs.items() if f.endswith('.webp'))
+    print(f'Image stats: {len(stats)} images encoded in {total:.2f}s of worker time, '
+          f'{source_bytes / 1024:.1f} KiB of source images, {webp_bytes / 1024:.1f} KiB of WebP')
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, since forking a process that is running scraper threads is not safe
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+# https://stackoverflow.com/a/65977483/6022481
+def square_image(image: 'Image', length: int) -> 'Image':
+    if image.size[0] == image.size[1]:
+        return image
+    elif image.size[0] < image.size[1]:
+        resized_image = image.resize((length, int(image.size[1] * (length / image.size[0]))))
+        required_loss = (resized_image.size[1] - length)
+        resized_image = resized_image.crop(
+            box=(0, required_loss / 2, length, resized_image.size[1] - required_loss / 2))
+        return resized_image
+    else:
+        resized_image = image.resize((int(image.size[0] * (length / image.size[1])), length))
+        required_loss = resized_image.size[0] - length
+        resized_image = resized_image.crop(
+            box=(required_loss / 2, 0, resized_image.size[0] - required_loss / 2, length))
+        return resized_image
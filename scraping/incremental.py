@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import json
+
+from scraping.records import load_records
+
+# section -> (item filter, timestamp field) used to compute the high-water mark of each source that can fetch only
+# what is newer. Oku has no such filter, so books are always fetched in full.
+WATERMARKS = {
+    'movies': (lambda m: not m['cinema'] and not m['is_favorite'], 'last_watch'),
+    'shows': (lambda s: not s['is_favorite'], 'last_watch'),
+}
+
+
+def load_previous_data(path='data/scraper.json'):
+    try:
+        with open(path, encoding='utf8') as f:
+            return load_records(json.load(f))
+    except (OSError, ValueError) as exc:
+        print(f'Warning: No previous scraper output to merge into ({exc}), running a full scrape')
+        return None
+
+
+def compute_watermarks(data):
+    watermarks = {}
+    for section, (include, field) in WATERMARKS.items():
+        values = [item[field] for item in data.get(section, []) if include(item)]
+        if values:
+            watermarks[section] = max(values)
+    return watermarks
+
+
+def plex_movies(movies):
+    return [m for m in movies if not m['cinema'] and not m['is_favorite']]
+
+
+def plex_shows(shows):
+    return [s for s in shows if not s['is_favorite']]
+
+
+def merge_by_key(new, old, key):
+    """New items first, then the old ones whose `key` was not seen again"""
+    seen = {item[key] for item in new}
+    return new + [item for item in old if item[key] not in seen]
+
+
+def merge_shows(new, old):
+    """Like merge_by_key on `guid`, but shows watched again keep their older episodes too"""
+    old_by_guid = {show['guid']: show for show in old}
+    for show in new:
+        previous = old_by_guid.get(show['guid'])
+        if previous is not None:
+            watched = {(ep['episode'], ep['watched_on']) for ep in show['episodes']}
+            show['episodes'] += [ep for ep in previous['episodes'] if (ep['episode'], ep['watched_on']) not in watched]
+    return merge_by_key(new, old, 'guid')
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+
+class ItemIndex:
+    """The items of one data section together with the set of their keys.
+
+    The scrapers of a media type share one index, so checking whether an item
+    was already collected is a set lookup instead of a scan of everything
+    scraped so far.
+    """
+
+    def __init__(self, items, key='guid'):
+        self.items = items
+        self.key = key
+        self._keys = {item[key] for item in items}
+
+    def __contains__(self, value):
+        return value in self._keys
+
+    def __len__(self):
+        return len(self.items)
+
+    def claim(self, value):
+        """Reserves `value` for an item that is appended later, returns False if it is already taken"""
+        if value in self._keys:
+            return False
+        self._keys.add(value)
+        return True
+
+    def add(self, item):
+        """Appends `item` unless an item with the same key is already there"""
+        if not self.claim(item[self.key]):
+            return False
+        self.items.append(item)
+        return True
+
+    def append(self, item):
+        self._keys.add(item[self.key])
+        self.items.append(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+
+def index_by(items, key):
+    """{item[key]: first item with that key}"""
+    index = {}
+    for item in items:
+        if key in item:
+            index.setdefault(item[key], item)
+    return index
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import base64
+import re
+from datetime import UTC, datetime
+from urllib import parse
+
+from scraping.index import index_by
+from scraping.records import Artist, Book, Episode, Game, Movie, Repo, Show
+
+CONTENT_LIMIT = 50
+PLEX_CONTENT_LIMIT = 999
+IMG_WIDTH = 350
+LETTERBOXD_RSS_URL = 'https://letterboxd.com/n3d1117/rss/'
+CINEMA_LISTS = ['🍿 Cinema', '🍿 Cinema 2', '🍿 Cinema 3']  # due to rss limit. waiting for letterboxd apis...
+TMDB_LIST_URL = 'https://api.themoviedb.org/3/list/{}?api_key={}'
+TMDB_FAV_MOVIES = '7112446'
+TMDB_FAV_SHOWS = '7112447'
+TMDB_IMAGE_URL = 'https://image.tmdb.org/t/p/w300'
+OKU_COLLECTION_URL = 'https://oku.club/api/collections/'
+OKU_READING = 'yjUNL'
+OKU_READ = 'xSQso'
+# OKU_TO_READ = 'I0Ai5'
+OKU_FAVORITES = 'IPgqn'
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+SPOTIFY_TOP_ARTISTS_URL = 'https://api.spotify.com/v1/me/top/artists'
+SPOTIFY_FALLBACK_IMAGE = 'https://upload.wikimedia.org/wikipedia/commons/5/50/Black_Wallpaper.jpg'
+GITHUB_REPOS_URL = 'https://api.github.com/users/{}/repos?per_page=500'.format('n3d1117')
+GITHUB_INCLUDE = ['chatgpt-telegram-bot', 'appdb', 'stats-ios', 'cook']
+GITHUB_EXCLUDE = ['CrackBot']
+TWITCH_TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
+# if same year, most recent first
+IGDB_GAME_IDS = ['154986', '43335', '732', '27081', '96209', '114287', '134101', '114285', '1020', '7331', '8837',
+                 '4647', '4649', '4648', '10662', '96', '3136', '19560', '6036', '157446', '112875', '205780']
+
+
+def plex_guid(metadata, field):
+    return metadata[field][1].split('//')[1]
+
+
+def plex_movie_item(movie, guid, images):
+    return Movie(
+        title=movie['title'],
+        guid=guid,
+        year=movie['year'],
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        last_watch=movie['last_watch'],
+        cinema=False,
+        is_favorite=False
+    )
+
+
+def cinema_movies(feed):
+    """Returns (feed entry, letterboxd link) for every movie in the cinema lists of the Letterboxd feed"""
+    lists = index_by(feed['entries'], 'title')
+    films = index_by(feed['entries'], 'letterboxd_filmtitle')
+    movies = []
+    for lbx_list in CINEMA_LISTS:
+        if lbx_list in lists:
+            cinema_movies_raw = re.findall("<li>(.*?)</li>", lists[lbx_list]['summary'])
+            for movie in cinema_movies_raw:
+                title = movie.split('">')[1].split('</a>')[0]
+                link = movie.split('href="')[1].split('"')[0]
+                if title in films:
+                    movies.append((films[title], link))
+    return movies
+
+
+def cinema_image_url(item):
+    return item['summary'].split('src="')[1].split('"')[0].replace('0-500-0-750', '0-230-0-345')
+
+
+def cinema_movie_item(item, link, images):
+    return Movie(
+        title=item['letterboxd_filmtitle'],
+        guid=link,
+        year=int(item['letterboxd_filmyear']),
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        last_watch=int(datetime.strptime(item['letterboxd_watcheddate'], "%Y-%m-%d").timestamp()),
+        cinema=True,
+        is_favorite=False
+    )
+
+
+def tmdb_movie_item(movie, images):
+    return Movie(
+        title=movie['title'],
+        guid=str(movie['id']),
+        year=int(movie['release_date'].split('-')[0]),
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        last_watch=int(datetime.strptime(movie['release_date'], "%Y-%m-%d").timestamp()),
+        cinema=False,
+        is_favorite=True
+    )
+
+
+def episode_code(row):
+    return 'S' + str(row['parent_media_index']) + 'E' + str(row['media_index'])
+
+
+def group_episodes(rows):
+    """Returns the most recent row of each show and the watched episodes keyed by `grandparent_rating_key`"""
+    unique_shows = []
+    unique_show_titles = set()
+    episodes = {}
+    for show in rows:
+        key = str(show['grandparent_rating_key'])
+
+        if show['grandparent_title'] not in unique_show_titles:
+            unique_show_titles.add(show['grandparent_title'])
+            unique_shows.append(show)
+        episodes.setdefault(key, []).append(Episode(
+            episode=episode_code(show),
+            name=show['grandchild_title'],
+            watched_on=show['last_watch']
+        ))
+    return unique_shows, episodes
+
+
+def plex_show_item(show, guid, episodes, images):
+    for ep in episodes:
+        ep.parent_show_id = guid
+    return Show(
+        title=show['grandparent_title'],
+        guid=guid,
+        ep=episode_code(show),
+        last_watch=show['last_watch'],
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        episodes=episodes,
+        is_favorite=False
+    )
+
+
+def tmdb_show_item(show, images):
+    return Show(
+        title=show['name'],
+        guid=str(show['id']),
+        ep=show['first_air_date'].split('-')[0],
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        last_watch=int(datetime.strptime(show['first_air_date'], "%Y-%m-%d").timestamp()),
+        episodes=[],
+        is_favorite=True
+    )
+
+
+def book_item(book, images, is_favorite=False, reading=False):
+    return Book(
+        title=book['title'],
+        author=book['authors'][0]['name'],
+        url='https://oku.club/book/' + book['slug'],
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+        added_at=int(datetime.strptime(book['addedAt'], "%Y-%m-%d").timestamp()),
+        is_favorite=is_favorite,
+        reading=reading
+    )
+
+
+def spotify_token_headers(client_id, client_secret):
+    auth_header = base64.urlsafe_b64encode((client_id + ':' + client_secret).encode('ascii'))
+    return {'Content-Type': 'application/x-www-form-urlencoded',
+            'Authorization': 'Basic {}'.format(auth_header.decode('ascii'))}
+
+
+def spotify_top_artists_url(content_limit):
+    return SPOTIFY_TOP_ARTISTS_URL + '?{}'.format(parse.urlencode({'time_range': 'short_term', 'limit': content_limit}))
+
+
+def artist_image_url(item):
+    return item['images'][1]['url'] if len(item['images']) > 1 else SPOTIFY_FALLBACK_IMAGE
+
+
+def artist_item(item, images):
+    return Artist(
+        name=item['name'],
+        url=item['external_urls']['spotify'],
+        followers=str(item['followers']['total']),
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+    )
+
+
+def github_projects(repos, content_limit, include=GITHUB_INCLUDE, exclude=GITHUB_EXCLUDE):
+    """The `include` repos first, then the most starred ones"""
+    by_name = index_by(repos, 'name')
+    projects = [by_name[i] for i in include]
+    skip = set(exclude) | set(include)
+    d = sorted(repos, key=lambda item: item['stargazers_count'], reverse=True)
+    return projects + [p for p in d if p['name'] not in skip][:content_limit]
+
+
+def repo_item(project):
+    return Repo(
+        name=project['name'],
+        html_url=project['html_url'],
+        description=project['description'],
+        language=project['language'],
+        stargazers_count=project['stargazers_count'],
+        forks_count=project['forks_count'],
+    )
+
+
+def game_cover_url(game):
+    return game['cover']['url'].replace('t_thumb', 't_cover_big').replace('//', 'https://')
+
+
+def game_item(game, images):
+    return Game(
+        name=game['name'],
+        url=game['url'],
+        year=int(datetime.fromtimestamp(int(game['first_release_date']), UTC).strftime('%Y')),
+        img=images['img'],
+        img_webp=images['img_webp'],
+        img_variants=images['img_variants'],
+        img_placeholder=images['img_placeholder'],
+    )
+
+
+def slugify(text):
+    from unidecode import unidecode
+
+    non_url_safe = ['"', '#', '$', '%', '&', '+', ',', '/', ':', ';', '=',
+                    '?', '@', '[', '\\', ']', '^', '`', '{', '|', '}', '~', "'", "(", ")"]
+    non_url_safe_regex = re.compile(r'[{}]'.format(''.join(re.escape(x) for x in non_url_safe)))
+    text = non_url_safe_regex.sub('', text).strip()
+    text = u'_'.join(re.split(r'\s+', text))
+    return unidecode(text.lower())
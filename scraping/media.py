@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+from os.path import exists
+
+import requests
+
+from scraping.image_store import image_name
+from scraping.images import IMAGE_DIR, image_variants
+from scraping.net import CHUNK_SIZE, HTTP_TIMEOUT, get_client
+from scraping.sync import get_content_type
+from scraping.trace import span
+
+DOWNLOAD_DIR = '.cache/downloads'  # images being downloaded, until their variants are encoded
+
+
+class Download:
+    """A response body streamed to `path`, hashed on the way; `path` is None for a 304"""
+
+    def __init__(self, status, headers, path=None, size=0, digest=None):
+        self.status = status
+        self.headers = headers
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    def discard(self):
+        if self.path is not None and exists(self.path):
+            os.remove(self.path)
+
+
+def resolve_name(store, media_type, slug, digest, entry=None):
+    """File name of the object, reusing the name of identical content saved earlier under another title"""
+    known = entry or store.find(media_type, digest)
+    return known['name'] if known is not None else image_name(media_type, slug, digest)
+
+
+def missing_variants(sync, variants):
+    """Variants that exist neither locally nor in the bucket, after removing empty local leftovers"""
+    for variant in variants:
+        path = f'{IMAGE_DIR}/{variant.filename}'
+        if exists(path) and is_zero_byte_file(path):
+            print(f'Removing empty {variant.filename}...')
+            os.remove(path)
+    return [v for v in variants if not valid_local_file(f'{IMAGE_DIR}/{v.filename}') and v.filename not in sync]
+
+
+def queue_transfers(sync, variants):
+    for variant in variants:
+        filename, path = variant.filename, f'{IMAGE_DIR}/{variant.filename}'
+        if valid_local_file(path):
+            sync.queue_upload(filename, path)
+        elif filename in sync:
+            sync.queue_download(filename, path)
+
+
+def record_image(store, sync, url, media_type, slug, digest, name, variants, size, headers):
+    """Records the image of `url`, removing the files of the image it replaced"""
+    superseded = store.record(url, media_type, slug, digest, name, [v.filename for v in variants], size,
+                              etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'))
+    if not superseded:
+        return
+    print(f'Removing {len(superseded)} superseded files of {url}...')
+    for filename in superseded:
+        path = f'{IMAGE_DIR}/{filename}'
+        if exists(path):
+            os.remove(path)
+    sync.queue_removal(superseded)
+
+
+def image_filenames(sync, name, ext, placeholder=None):
+    webp_filename = f'{name}.webp'
+    has_webp = valid_local_file(f'{IMAGE_DIR}/{webp_filename}') or webp_filename in sync
+    return {
+        'img': f'{name}.{ext}',
+        'img_webp': webp_filename if has_webp else f'{name}.{ext}',
+        'img_variants': resized_variants(sync, name, ext),
+        'img_placeholder': placeholder,
+    }
+
+
+def last_good_filenames(store, sync, url, media_type, slug, ext):
+    """Filenames of the image last stored for `url`, for when it could not be processed again.
+
+    Falls back to the unhashed name only when the image was never stored.
+    """
+    _, entry = store.lookup(url)
+    if entry is None:
+        return image_filenames(sync, f'{media_type}_{slug}', ext)
+    return image_filenames(sync, entry['name'], ext, entry.get('placeholder'))
+
+
+def resized_variants(sync, name, ext):
+    """The resized variants that exist locally or in the bucket, for templates to build a srcset from"""
+    variants = []
+    for variant in image_variants(name, ext):
+        path = f'{IMAGE_DIR}/{variant.filename}'
+        size = os.path.getsize(path) if valid_local_file(path) else sync.size(variant.filename)
+        if variant.width is not None and size is not None:
+            variants.append({'width': variant.width, 'type': get_content_type(variant.filename),
+                             'url': f'/img/{variant.filename}', 'bytes': size})
+    return variants
+
+
+def conditional_headers(source):
+    headers = {}
+    if source.get('etag'):
+        headers['If-None-Match'] = source['etag']
+    if source.get('last_modified'):
+        headers['If-Modified-Since'] = source['last_modified']
+    return headers
+
+
+def download(url, retries=3, timeout=HTTP_TIMEOUT, headers=None):
+    """Streams `url` to a file under DOWNLOAD_DIR in chunks, computing its sha256 as they arrive.
+
+    A body cut off midway is resumed from the end of the .part file with a
+    Range request (If-Range makes the server send it whole if it changed).
+    """
+    tmp_path = download_part_path()
+    try:
+        return stream_to(url, tmp_path, retries, timeout, headers)
+    finally:
+        if exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stream_to(url, tmp_path, retries, timeout, headers):
+    written, validator = 0, None
+    with span('download', 'image') as s:
+        for attempt in range(1, retries + 1):
+            try:
+                response = get_client().get(url, retries=retries, timeout=timeout, stream=True,
+                                            headers=resume_headers(headers, written, validator))
+            except requests.exceptions.RequestException as exc:
+                raise RuntimeError(f'Failed to download {url} after {retries} attempts') from exc
+            try:
+                if response.status_code == 304:
+                    return Download(304, response.headers)
+                response.raise_for_status()
+                if not written or response.status_code != 206:
+                    written, sha256 = 0, hashlib.sha256()
+                    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                with open(tmp_path, 'ab' if written else 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        written += len(chunk)
+            except requests.exceptions.HTTPError as exc:
+                raise RuntimeError(f'Failed to download {url}: {exc}') from exc
+            except requests.exceptions.RequestException as exc:
+                if attempt == retries:
+                    raise RuntimeError(f'Failed to download {url} after {retries} attempts') from exc
+                print(f'Download of {url} interrupted after {written} bytes (attempt {attempt}/{retries}): {exc}. '
+                      f'Resuming...')
+                continue
+            finally:
+                response.close()
+            path = tmp_path.removesuffix('.part')
+            os.replace(tmp_path, path)
+            s.set(bytes=written, status=response.status_code)
+            return Download(response.status_code, response.headers, path, written, sha256.hexdigest())
+
+
+def download_part_path():
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix='.part', dir=DOWNLOAD_DIR)  # unique, the same url can be in flight twice
+    os.close(fd)
+    return path
+
+
+def resume_headers(headers, written, validator):
+    """Request headers asking for the rest of a body of which `written` bytes were received"""
+    if not written:
+        return headers
+    return {'Range': f'bytes={written}-', **({'If-Range': validator} if validator else {})}
+
+
+def create_img_folder():
+    if not exists(IMAGE_DIR):
+        os.makedirs(IMAGE_DIR)
+
+
+def valid_local_file(path):
+    return exists(path) and not is_zero_byte_file(path)
+
+
+def read_local_file(path):
+    if not valid_local_file(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def is_zero_byte_file(path):
+    return exists(path) and os.path.getsize(path) == 0
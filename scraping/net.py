@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from scraping.deadline import bounded, remaining
+from scraping.trace import span
+
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_MAX_BACKOFF = 10
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}  # whose RETRY_STATUSES answers are retried by default
+DEFAULT_HOST_LIMIT = 4
+HOST_LIMITS = {
+    'image.tmdb.org': 8,
+    'a.ltrbxd.com': 8,
+    'images.igdb.com': 8,
+    'api.igdb.com': 4,  # IGDB allows 4 requests/sec
+}
+POOL_CONNECTIONS = 16
+CHUNK_SIZE = 64 * 1024  # streamed bodies are read and written in pieces of this size
+BREAKER_FAILURES = 5  # failed requests in a row, however many attempts each took, before a host is left alone
+BREAKER_COOLDOWN = 60
+LATENCY_WINDOW = 200  # recent response times per host that the hedging delay is computed from
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+HEDGE_WORKERS = 64
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.connections = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.handshake = 0.0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    @property
+    def transfer(self):
+        return max(self.elapsed - self.handshake, 0.0)
+
+    @property
+    def p95(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return sorted(self.latencies)[int(len(self.latencies) * 0.95)]
+
+    def hedge_delay(self):
+        """How long to wait for a response before sending a duplicate request, None while too few are known"""
+        p95 = self.p95
+        return None if p95 is None else max(p95, HEDGE_MIN_DELAY)
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The deadline of the source ran out, the request was not sent"""
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """The host failed too many times in a row, the request was not sent"""
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host (and port) after `failures` failed requests in a row.
+
+    Once `cooldown` seconds have passed, a single trial request goes through:
+    a response closes the breaker again, another failure keeps it open for
+    one more cooldown. Callers fall back to the last good data meanwhile.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}  # host -> when it was opened or last let a trial request through
+        self._lock = threading.Lock()
+
+    def allow(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.cooldown:
+                return False
+            self._opened[host] = time.monotonic()
+            return True
+
+    def success(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._failures.pop(host, None)
+            if self._opened.pop(host, None) is not None:
+                print(f'{host} is responding again, circuit closed')
+
+    def failure(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            failures = self._failures[host] = self._failures.get(host, 0) + 1
+            if failures >= self.failures:
+                if host not in self._opened:
+                    print(f'Warning: {host} failed {failures} times in a row, circuit open for {self.cooldown}s')
+                self._opened[host] = time.monotonic()
+
+    def open_hosts(self):
+        with self._lock:
+            return sorted(self._opened)
+
+
+class HttpClient:
+    """Thread-safe HTTP client with a keep-alive pool and a concurrency cap per host.
+
+    Timeouts and retries stay within the deadline of the calling source (see
+    scraping.deadline), and a CircuitBreaker fails requests to hosts that keep
+    failing right away. With `hedge`, a GET still unanswered after the p95
+    response time of its host (counted from when it got a slot of the host) is
+    sent a second time and the first response wins.
+
+    `recorder` captures every response into fixtures, `replay` sends every
+    request to a scraping.replay.ReplayServer instead of the real host.
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF,
+                 host_limits=None, default_host_limit=DEFAULT_HOST_LIMIT, recorder=None, replay=None, hedge=False):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.host_limits = dict(HOST_LIMITS if host_limits is None else host_limits)
+        self.default_host_limit = default_host_limit
+        self.recorder = recorder
+        self.replay = replay
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        self._stats = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        self._hedges = ThreadPoolExecutor(max_workers=HEDGE_WORKERS) if hedge else None
+        self._session = requests.Session()
+        pool_size = max([default_host_limit, *self.host_limits.values()])
+        adapter = _TimedAdapter(self._record_handshake, rewrite=replay.rewrite if replay is not None else None,
+                                pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if recorder is not None:
+            self._session.hooks['response'].append(recorder.record_response)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, retries=None, timeout=None, retry_status=None, **kwargs):
+        """With `stream=True` the body is left unread, for the caller to iterate and close.
+
+        Answers in RETRY_STATUSES are only retried for IDEMPOTENT_METHODS, unless
+        `retry_status` says otherwise (e.g. for read-only POST queries). The
+        circuit breaker counts the request once, however many attempts it took.
+        """
+        host = urlsplit(url).hostname or ''
+        retries = self.retries if retries is None else retries
+        timeout = self.timeout if timeout is None else timeout
+        retry_status = method in IDEMPOTENT_METHODS if retry_status is None else retry_status
+
+        with span(host, 'http', method=method, path=urlsplit(url).path) as s:
+            for attempt in range(1, retries + 1):
+                s.set(retries=attempt - 1)
+                self._check(host, url)
+                try:
+                    response = self._send(host, method, url, bounded(timeout), **kwargs)
+                except requests.exceptions.RequestException as exc:
+                    if attempt == retries:
+                        self.breaker.failure(url)
+                        raise
+                    self._wait_before_retry(host, url, attempt, retries, exc)
+                    continue
+
+                if response.status_code in RETRY_STATUSES and retry_status and attempt < retries:
+                    response.close()
+                    self._wait_before_retry(host, url, attempt, retries, f'HTTP {response.status_code}',
+                                            response.headers.get('Retry-After'))
+                    continue
+                if response.status_code in RETRY_STATUSES:
+                    self.breaker.failure(url)
+                else:
+                    self.breaker.success(url)
+                s.set(status=response.status_code, bytes=body_size(response, kwargs.get('stream')))
+                if response.status_code >= 400:
+                    s.outcome = f'HTTP {response.status_code}'
+                return response
+
+    def close(self):
+        """Closes the pooled connections and stops the hedging threads"""
+        if self._hedges is not None:
+            self._hedges.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
+
+    def set_host_limit(self, host, limit):
+        with self._lock:
+            self.host_limits[host] = limit
+            self._semaphores.pop(host, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def print_stats(self):
+        print_host_stats(self.stats(), self.breaker.open_hosts())
+
+    def _check(self, host, url):
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded(f'Deadline exceeded, not requesting {url}')
+        if not self.breaker.allow(url):
+            raise CircuitOpen(f'Circuit open for {urlsplit(url).netloc}, not requesting {url}')
+
+    def _send(self, host, method, url, timeout, **kwargs):
+        """One attempt, duplicated once it takes longer than the host usually does if hedging is on"""
+        delay = self._hedge_delay(host, method, kwargs)
+        if delay is None:
+            return self._send_once(host, method, url, timeout, **kwargs)
+        sent = threading.Event()
+        first = self._hedges.submit(self._send_once, host, method, url, timeout, sent, **kwargs)
+        sent.wait()  # a request still queued for the host is not slow, and a duplicate would queue behind it
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        second = self._hedges.submit(self._send_once, host, method, url, timeout, **kwargs)
+        with self._lock:
+            self._host_stats(host).hedges += 1
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    if future is second:
+                        with self._lock:
+                            self._host_stats(host).hedges_won += 1
+                    return future.result()
+        return first.result()
+
+    def _send_once(self, host, method, url, timeout, sent=None, **kwargs):
+        """Sends the request once a slot of the host is free, setting the `sent` event then"""
+        with self._host_semaphore(host):
+            if sent is not None:
+                sent.set()
+            start = time.perf_counter()  # time spent queued for the host is not the host's
+            try:
+                response = self._session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException:
+                self._record(host, time.perf_counter() - start, error=True)
+                raise
+            elapsed = time.perf_counter() - start
+        self._record(host, elapsed, body_size(response, kwargs.get('stream')),
+                     response.status_code not in RETRY_STATUSES)
+        return response
+
+    def _hedge_delay(self, host, method, kwargs):
+        if not self.hedge or method != 'GET' or kwargs.get('stream'):
+            return None
+        with self._lock:
+            return self._host_stats(host).hedge_delay()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                limit = self.host_limits.get(host, self.default_host_limit)
+                self._semaphores[host] = threading.BoundedSemaphore(limit)
+            return self._semaphores[host]
+
+    def _host_stats(self, host):
+        if host not in self._stats:
+            self._stats[host] = HostStats()
+        return self._stats[host]
+
+    def _record(self, host, elapsed, size=0, answered=False, error=False):
+        with self._lock:
+            s = self._host_stats(host)
+            s.requests += 1
+            s.elapsed += elapsed
+            if error:
+                s.errors += 1
+            if answered:
+                s.latencies.append(elapsed)
+            s.bytes += size
+
+    def _record_handshake(self, host, elapsed):
+        with self._lock:
+            s = self._host_stats(host)
+            s.connections += 1
+            s.handshake += elapsed
+
+    def _wait_before_retry(self, host, url, attempt, retries, reason, retry_after=None):
+        with self._lock:
+            self._host_stats(host).retries += 1
+        delay = bounded(retry_delay(self.backoff, attempt, retry_after))
+        print(f'Request failed for {url} (attempt {attempt}/{retries}): {reason}. Retrying in {delay:.1f}s...')
+        time.sleep(delay)
+
+
+class _TimedAdapter(HTTPAdapter):
+    """Transport adapter whose connections report how long TCP + TLS setup took"""
+
+    def __init__(self, on_connect, rewrite=None, **kwargs):
+        self._on_connect = on_connect
+        self._rewrite = rewrite
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self._rewrite is not None:
+            request.url = self._rewrite(request.url)
+        return super().send(request, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _timed_pool(HTTPConnectionPool, HTTPConnection, self._on_connect),
+            'https': _timed_pool(HTTPSConnectionPool, HTTPSConnection, self._on_connect),
+        }
+
+
+def _timed_pool(pool_cls, connection_cls, on_connect):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection_cls.connect(self)
+        finally:
+            on_connect(self.host, time.perf_counter() - start)
+
+    timed_connection = type(f'Timed{connection_cls.__name__}', (connection_cls,), {'connect': connect})
+    return type(f'Timed{pool_cls.__name__}', (pool_cls,), {'ConnectionCls': timed_connection})
+
+
+def retry_delay(backoff, attempt, retry_after=None):
+    delay = min(backoff * 2 ** (attempt - 1), HTTP_MAX_BACKOFF)
+    if retry_after and retry_after.isdigit():
+        delay = min(int(retry_after), HTTP_MAX_BACKOFF)
+    return delay
+
+
+def _close_response(future):
+    """Closes the response of a hedged request that lost the race, once it arrives"""
+    if future.exception() is None:
+        future.result().close()
+
+
+def body_size(response, streamed=False):
+    """Bytes of the body, taken from Content-Length for streamed responses whose body is not read yet"""
+    if not streamed:
+        return len(response.content)
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else 0
+
+
+def print_host_stats(stats, open_hosts=()):
+    if open_hosts:
+        print(f'Circuits still open: {", ".join(open_hosts)}')
+    if not stats:
+        return
+    print('HTTP stats:')
+    for host, s in sorted(stats.items(), key=lambda item: item[1].elapsed, reverse=True):
+        hedges = f', {s.hedges} hedged ({s.hedges_won} won)' if s.hedges else ''
+        p95 = f', p95 {s.p95 * 1000:.0f}ms' if s.p95 is not None else ''
+        print(f'  {host}: {s.requests} requests ({s.errors} errors, {s.retries} retries{hedges}), '
+              f'{s.connections} connections, {s.bytes / 1024:.1f} KiB, '
+              f'handshake {s.handshake:.2f}s, transfer {s.transfer:.2f}s{p95}')
+
+
+def configure_client(**kwargs):
+    """Replaces the shared client, closing the previous one (e.g. of the last run of the daemon)"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(**kwargs)
+        return _client
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
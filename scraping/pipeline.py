@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+import time
+
+from scraping.deadline import current_deadline, until
+from scraping.image_store import get_image_store, object_key
+from scraping.images import IMAGE_DIR, image_variants, write_variants
+from scraping.media import (conditional_headers, download, image_filenames, last_good_filenames, missing_variants,
+                            queue_transfers, record_image, resolve_name, valid_local_file)
+from scraping.sync import SYNC_CONCURRENCY
+
+DOWNLOAD_CONCURRENCY = 8
+ENCODE_CONCURRENCY = os.cpu_count() or 1
+QUEUE_SIZE = 32
+# what the item builders get while the image is still in the pipeline, filled in by the time the run ends
+PENDING_IMAGES = {'img': None, 'img_webp': None, 'img_variants': None, 'img_placeholder': None}
+
+
+class StageStats:
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.blocked = 0.0  # time producers spent waiting for room in the queue
+        self.max_depth = 0
+        self.depth_total = 0
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def wall(self):
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    @property
+    def throughput(self):
+        return self.processed / self.wall if self.wall else 0.0
+
+    @property
+    def mean_depth(self):
+        return self.depth_total / (self.processed + self.failed) if self.processed + self.failed else 0.0
+
+
+class Stage:
+    """A bounded queue consumed by `workers` threads calling `func(job)`.
+
+    `put` blocks while the queue is full, so a slow stage holds back the ones
+    feeding it instead of buffering every job in memory.
+    """
+
+    def __init__(self, name, func, workers, on_error, maxsize=QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize)
+        self.stats = StageStats()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, job):
+        start = time.perf_counter()
+        self.queue.put(job)
+        blocked = time.perf_counter() - start
+        with self._lock:
+            depth = self.queue.qsize()
+            self.stats.blocked += blocked
+            self.stats.max_depth = max(self.stats.max_depth, depth)
+            self.stats.depth_total += depth
+            if self.stats.started_at is None:
+                self.stats.started_at = time.perf_counter()
+
+    def close(self):
+        """Waits for every queued job, then stops the workers"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            start = time.perf_counter()
+            failed = False
+            try:
+                self.func(job)
+            except Exception as exc:
+                failed = True
+                self.on_error(job, exc)
+            with self._lock:
+                self.stats.busy += time.perf_counter() - start
+                self.stats.finished_at = time.perf_counter()
+                if failed:
+                    self.stats.failed += 1
+                else:
+                    self.stats.processed += 1
+
+
+class ImageJob:
+    def __init__(self, item, media_type, slug, ext, url, square=False):
+        self.item = item
+        self.media_type = media_type
+        self.slug = slug
+        self.ext = ext
+        self.url = url
+        self.square = square
+        self.download = None
+        self.refetch = None  # the image downloaded again when no copy of an unchanged one is left
+        self.source = None  # image file the variants are encoded from
+        self.key = None
+        self.name = None
+        self.variants = None
+        self.missing = None
+        self.placeholder = None
+        self.deadline = current_deadline()  # of the source that submitted it
+
+    @property
+    def filename(self):
+        return f'{self.media_type}_{self.slug}.{self.ext}'
+
+    def discard_downloads(self):
+        for d in (self.download, self.refetch):
+            if d is not None:
+                d.discard()
+
+
+class ImagePipeline:
+    """Downloads, encodes and uploads item images in the background while the scrapers keep going.
+
+    Scrapers `submit` the item together with its image and move on to the next
+    one; the item's `img`/`img_webp` are filled in once the image is done.
+    Each stage has its own queue and worker count, and jobs for content that is
+    already in flight wait for it instead of being encoded twice.
+    """
+
+    def __init__(self, sync, download_workers=DOWNLOAD_CONCURRENCY, encode_workers=ENCODE_CONCURRENCY,
+                 transfer_workers=SYNC_CONCURRENCY):
+        self.sync = sync
+        self.store = get_image_store()
+        self.stages = [
+            Stage('download', self._download, download_workers, self._fail),
+            Stage('encode', self._encode, encode_workers, self._fail),
+            Stage('transfer', self._transfer, transfer_workers, self._transfer_failed),
+        ]
+        self._download_stage, self._encode_stage, self._transfer_stage = self.stages
+        self._in_flight = {}  # object key -> jobs waiting for the leader job with the same content
+        self._lock = threading.Lock()
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def submit(self, item, media_type, slug, ext, url, square=False):
+        self._download_stage.put(ImageJob(item, media_type, slug, ext, url, square))
+
+    def join(self):
+        """Drains the stages in order, after which every submitted item has its image filenames"""
+        for stage in self.stages:
+            stage.close()
+
+    def print_stats(self):
+        if not any(stage.stats.processed or stage.stats.failed for stage in self.stages):
+            return
+        print('Image pipeline stats:')
+        for stage in self.stages:
+            s = stage.stats
+            print(f'  {stage.name}: {s.processed} done, {s.failed} failed in {s.wall:.2f}s ({s.throughput:.1f}/s), '
+                  f'{stage.workers} workers {s.busy:.2f}s busy, queue depth max {s.max_depth} '
+                  f'mean {s.mean_depth:.1f}, producers blocked {s.blocked:.2f}s')
+
+    def _download(self, job):
+        with until(job.deadline):
+            self._fetch(job)
+
+    def _fetch(self, job):
+        self.store.pull(self.sync)  # knows the images of earlier builds, and loads the bucket manifest
+        source, entry = self.store.lookup(job.url)
+        if entry is None:
+            print(f'Saving {job.filename} locally...')
+            job.download = download(job.url)
+        elif not self.store.is_fresh(source):
+            job.download = download(job.url, headers=conditional_headers(source))
+            if job.download.status == 304:
+                self.store.touch(job.url)
+                job.download = None
+
+        digest = job.download.digest if job.download is not None else source['key'].split(':', 1)[1]
+        job.key = object_key(job.media_type, digest)
+        with self._lock:
+            if job.key in self._in_flight:
+                self._in_flight[job.key].append(job)
+                return
+            self._in_flight[job.key] = []
+
+        job.name = resolve_name(self.store, job.media_type, job.slug, digest, entry if job.download is None else None)
+        job.variants = image_variants(job.name, job.ext)
+        job.missing = missing_variants(self.sync, job.variants)
+        job.placeholder = self.store.placeholder(job.key)
+        if not job.missing and job.placeholder is not None:
+            self._finish(job)
+            return
+        job.source = job.download.path if job.download is not None else self._local_source(job)
+        self._encode_stage.put(job)
+
+    def _local_source(self, job):
+        """The original variant if it is here or in the bucket, else a new download"""
+        filename = job.variants[0].filename
+        path = f'{IMAGE_DIR}/{filename}'
+        if not valid_local_file(path) and filename in self.sync:
+            self.sync.download_to(filename, path)
+        if valid_local_file(path):
+            return path
+        job.refetch = download(job.url)
+        return job.refetch.path
+
+    def _encode(self, job):
+        placeholder = write_variants(job.source, job.missing, square=job.square, img_folder=IMAGE_DIR,
+                                     placeholder=job.placeholder is None)
+        job.placeholder = job.placeholder or placeholder
+        self._finish(job)
+
+    def _finish(self, job):
+        queue_transfers(self.sync, job.variants)
+        with self._lock:
+            followers = self._in_flight.pop(job.key, [])
+        for done in [job] + followers:
+            if done.download is not None:
+                record_image(self.store, self.sync, done.url, done.media_type, done.slug, job.key.split(':', 1)[1],
+                             job.name, job.variants, done.download.size, done.download.headers)
+            done.discard_downloads()
+            done.item.update(image_filenames(self.sync, job.name, done.ext, job.placeholder))
+        self.store.set_placeholder(job.key, job.placeholder)
+
+        downloads, uploads = self.sync.take_queued()
+        for name, path in downloads.items():
+            self._transfer_stage.put((self.sync.download_to, name, path))
+        for name, path in uploads.items():
+            self._transfer_stage.put((self.sync.upload_from, name, path))
+
+    def _transfer(self, transfer):
+        func, name, path = transfer
+        func(name, path)
+
+    def _fail(self, job, exc):
+        print(f'Warning: Image processing failed for {job.filename}: {exc}')
+        followers = []
+        if job.key is not None:  # only the leader of an object can fail once its key is known
+            with self._lock:
+                followers = self._in_flight.pop(job.key, [])
+        for failed in [job] + followers:
+            failed.discard_downloads()
+            failed.item.update(last_good_filenames(self.store, self.sync, failed.url, failed.media_type, failed.slug,
+                                                   failed.ext))
+
+    def _transfer_failed(self, transfer, exc):
+        print(f'Warning: Sync failed for {transfer[1]}: {exc}')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from scraping.cache import get_cache
+from scraping.deadline import carry
+from scraping.net import get_client
+
+PLEX_CONCURRENCY = 8
+
+
+class PlexSource:
+    """Plex watch history shared by the movie and TV show scrapers.
+
+    The history is downloaded once no matter how many scrapers ask for it, and
+    metadata lookups are resolved concurrently and remembered by `rating_key`.
+    """
+
+    def __init__(self, history_url, metadata_url, user, proxy_img, concurrency=PLEX_CONCURRENCY):
+        self.history_url = history_url
+        self.metadata_url = metadata_url
+        self.user = user
+        self.proxy_img = proxy_img
+        self.concurrency = concurrency
+        self._rows = None
+        self._metadata = {}
+        self._history_lock = threading.Lock()
+        self._metadata_lock = threading.Lock()
+        get_client().set_host_limit(urlsplit(metadata_url).hostname, concurrency)
+
+    @classmethod
+    def from_env(cls):
+        return cls(history_url=os.environ.get('PLEX_URL'),
+                   metadata_url=os.environ.get('PLEX_METADATA_URL'),
+                   user=os.environ.get('PLEX_USER'),
+                   proxy_img=os.environ.get('PLEX_PROXY_IMG'))
+
+    def rows(self, media_type):
+        with self._history_lock:
+            if self._rows is None:
+                plex_json = get_client().get(url=self.history_url).json()
+                self._rows = [row for row in plex_json['response']['data']['rows'] if row['user'] == self.user]
+        return [row for row in self._rows if row['media_type'] == media_type]
+
+    def metadata(self, rating_keys):
+        """Returns {rating_key: metadata} for every key that resolved, fetching the unknown ones in parallel"""
+        rating_keys = [str(k) for k in rating_keys]
+        with self._metadata_lock:
+            missing = list(dict.fromkeys(k for k in rating_keys if k not in self._metadata))
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for key, data in zip(missing, executor.map(carry(self._fetch_metadata), missing)):
+                    if data is not None:
+                        with self._metadata_lock:
+                            self._metadata[key] = data
+        with self._metadata_lock:
+            return {k: self._metadata[k] for k in rating_keys if k in self._metadata}
+
+    def image_url(self, thumb, width):
+        return self.proxy_img + thumb + '&width=' + str(width)
+
+    def _fetch_metadata(self, rating_key):
+        try:
+            j = get_cache().fetch_json(self.metadata_url + rating_key, 'plex_metadata')
+            return j['response']['data']
+        except Exception as exc:
+            print(f'Warning: Error fetching metadata for {rating_key}: {exc}')
+            return None
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from dataclasses import dataclass, field
+
+
+class Record:
+    """Slotted item of the scraper output.
+
+    Items keep the dict-style access the merge, dedup and image code already
+    uses (`item['guid']`, `item.update(...)`), and serialize with their fields
+    in declaration order, so the JSON is the same the Hugo templates read.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self.__slots__ else default
+
+    def update(self, values):
+        for name, value in values.items():
+            self[name] = value
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{name: values.get(name) for name in cls.__slots__})
+
+
+@dataclass(slots=True)
+class Movie(Record):
+    title: str
+    guid: str
+    year: int
+    img: str
+    img_webp: str
+    last_watch: int
+    cinema: bool = False
+    is_favorite: bool = False
+    img_variants: list = None  # resized variants for srcset, see media.resized_variants
+    img_placeholder: str = None
+
+
+@dataclass(slots=True)
+class Episode(Record):
+    episode: str
+    name: str
+    watched_on: int
+    parent_show_id: str = None
+
+
+@dataclass(slots=True)
+class Show(Record):
+    title: str
+    guid: str
+    ep: str
+    last_watch: int
+    img: str
+    img_webp: str
+    episodes: list = field(default_factory=list)
+    is_favorite: bool = False
+    img_variants: list = None
+    img_placeholder: str = None
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values, episodes=[Episode.from_dict(ep) for ep in values.get('episodes') or []])
+        return super(Show, cls).from_dict(values)  # slotted dataclasses are rebuilt, so no zero-argument super()
+
+
+@dataclass(slots=True)
+class Book(Record):
+    title: str
+    author: str
+    url: str
+    img: str
+    img_webp: str
+    added_at: int
+    is_favorite: bool = False
+    reading: bool = False
+    img_variants: list = None
+    img_placeholder: str = None
+
+
+@dataclass(slots=True)
+class Artist(Record):
+    name: str
+    url: str
+    followers: str
+    img: str
+    img_webp: str
+    img_variants: list = None
+    img_placeholder: str = None
+
+
+@dataclass(slots=True)
+class Repo(Record):
+    name: str
+    html_url: str
+    description: str
+    language: str
+    stargazers_count: int
+    forks_count: int
+
+
+@dataclass(slots=True)
+class Game(Record):
+    name: str
+    url: str
+    year: int
+    img: str
+    img_webp: str
+    img_variants: list = None
+    img_placeholder: str = None
+
+
+SECTION_RECORDS = {'movies': Movie, 'shows': Show, 'books': Book, 'spotify': Artist, 'github': Repo,
+                   'videogames': Game}
+
+
+def load_records(data):
+    """Turns the sections of a loaded scraper.json back into records"""
+    return {section: [SECTION_RECORDS[section].from_dict(item) for item in items] if section in SECTION_RECORDS
+            else items for section, items in data.items()}
+
+
+def encode_record(obj):
+    """`default` hook of json.dumps for records"""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
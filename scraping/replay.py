@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import http.server
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+# response headers worth replaying, the body is stored decoded so the transfer headers are dropped
+REPLAY_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After', 'Cache-Control')
+
+
+class Recorder:
+    """Captures every HTTP response and bucket call of a run into a fixture directory.
+
+    Fixtures are keyed by method, URL and request body. URLs and bodies may hold
+    API keys, so keep fixture directories out of the repository.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.storage = {'download': {}, 'list': {}, 'exists': {}}
+        self.count = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'http'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'storage'), exist_ok=True)
+
+    def record_response(self, response, *args, **kwargs):
+        """`requests` response hook"""
+        request = response.request
+        self.record_http(request.method, request.url, request.body, response.status_code, response.headers,
+                         response.content, response.elapsed.total_seconds())
+
+    async def arecord_response(self, response):
+        """`httpx` response hook"""
+        await response.aread()
+        request = response.request
+        self.record_http(request.method, str(request.url), request.content, response.status_code, response.headers,
+                         response.content)
+
+    def record_http(self, method, url, body, status, headers, content, elapsed=None):
+        key = fixture_key(method, url, body)
+        write_file(os.path.join(self.path, 'http', f'{key}.body'), content)
+        entry = {'method': method, 'url': url, 'status': status, 'elapsed': elapsed,
+                 'headers': {h: headers[h] for h in REPLAY_HEADERS if h in headers}}
+        write_file(os.path.join(self.path, 'http', f'{key}.json'), json.dumps(entry, indent=1).encode('utf8'))
+        with self._lock:
+            self.count += 1
+
+    def record_storage(self, op, name, result=None, error=None):
+        if op == 'download' and error is None:
+            digest = hashlib.sha256(result).hexdigest()
+            write_file(os.path.join(self.path, 'storage', f'{digest}.bin'), result)
+            result = digest
+        with self._lock:
+            self.storage[op][name] = {'error': error} if error is not None else {'result': result}
+
+    def save(self):
+        with self._lock:
+            index = json.dumps(self.storage, indent=1, sort_keys=True).encode('utf8')
+        write_file(os.path.join(self.path, 'storage', 'index.json'), index)
+        print(f'Recorded {self.count} HTTP responses into {self.path}')
+
+
+class RecordingBucket:
+    """Bucket proxy that records what the real bucket returned"""
+
+    def __init__(self, bucket, recorder):
+        self.bucket = bucket
+        self.recorder = recorder
+
+    def download(self, name):
+        return self._call('download', name, self.bucket.download, name)
+
+    def list(self, options=None):
+        return self._call('list', str((options or {}).get('offset', 0)), self.bucket.list, options=options)
+
+    def exists(self, name):
+        return self._call('exists', name, self.bucket.exists, name)
+
+    def upload(self, name, content, file_options=None):
+        return self.bucket.upload(name, content, file_options=file_options)
+
+    def remove(self, paths):
+        return self.bucket.remove(paths)
+
+    def _call(self, op, name, func, *args, **kwargs):
+        from storage3.utils import StorageException
+
+        try:
+            result = func(*args, **kwargs)
+        except StorageException as exc:
+            self.recorder.record_storage(op, name, error=str(exc))
+            raise
+        self.recorder.record_storage(op, name, result)
+        return result
+
+
+class ReplayServer:
+    """Local stand-in for every recorded API, serving the fixtures with a configurable delay.
+
+    Clients rewrite `https://host/path` to `http://127.0.0.1:port/https/host/path`.
+    `latency` is in seconds, or 'recorded' to sleep for as long as the
+    original request took. `bucket` stands in for the storage bucket.
+    """
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self.bucket = ReplayBucket(path, latency)
+        self.requests = {}  # host -> count
+        self.missing = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        replay = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                replay.serve(self)
+
+            do_POST = do_PUT = do_HEAD = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='replay-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def rewrite(self, url):
+        parts = urlsplit(url)
+        query = f'?{parts.query}' if parts.query else ''
+        return f'{self.base_url}/{parts.scheme}/{parts.netloc}{parts.path}{query}'
+
+    def serve(self, handler):
+        scheme, _, rest = handler.path.lstrip('/').partition('/')
+        url = f'{scheme}://{rest}'
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else None
+        key = fixture_key(handler.command, url, body)
+        with self._lock:
+            host = urlsplit(url).hostname
+            self.requests[host] = self.requests.get(host, 0) + 1
+
+        try:
+            with open(os.path.join(self.path, 'http', f'{key}.json'), encoding='utf8') as f:
+                entry = json.load(f)
+            with open(os.path.join(self.path, 'http', f'{key}.body'), 'rb') as f:
+                content = f.read()
+        except OSError:
+            with self._lock:
+                self.missing.append(f'{handler.command} {url}')
+            entry, content = {'status': 404, 'headers': {}}, b''
+
+        time.sleep(self.delay(entry))
+        handler.send_response(entry['status'])
+        for name, value in entry['headers'].items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(content)
+
+    def print_stats(self):
+        print(f'Replay: {sum(self.requests.values())} HTTP requests, {len(self.missing)} without a fixture, '
+              'bucket ' + ', '.join(f'{count} {op}' for op, count in sorted(self.bucket.calls.items())))
+        for request in self.missing[:10]:
+            print(f'  no fixture for {request}')
+
+    def delay(self, entry):
+        if self.latency == 'recorded':
+            return entry.get('elapsed') or 0.0
+        return self.latency
+
+
+class ReplayBucket:
+    """Serves the recorded bucket calls, uploads only live for the current run"""
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self.calls = {}  # op -> count
+        self.uploaded = {}
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(path, 'storage', 'index.json'), encoding='utf8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {'download': {}, 'list': {}, 'exists': {}}
+
+    def download(self, name):
+        self._count('download')
+        with self._lock:
+            if name in self.uploaded:
+                return self.uploaded[name]
+        entry = self._entry('download', name)
+        with open(os.path.join(self.path, 'storage', f'{entry["result"]}.bin'), 'rb') as f:
+            return f.read()
+
+    def list(self, options=None):
+        self._count('list')
+        return self._entry('list', str((options or {}).get('offset', 0)))['result']
+
+    def exists(self, name):
+        self._count('exists')
+        with self._lock:
+            if name in self.uploaded:
+                return True
+        if 'result' in self.index['download'].get(name, {}):
+            return True
+        return self.index['exists'].get(name, {}).get('result', False)
+
+    def upload(self, name, content, file_options=None):
+        from storage3.utils import StorageException
+
+        self._count('upload')
+        with self._lock:
+            if name in self.uploaded and (file_options or {}).get('upsert') != 'true':
+                raise StorageException({'message': 'The resource already exists', 'statusCode': 409})
+            self.uploaded[name] = content
+
+    def remove(self, paths):
+        self._count('remove')
+        with self._lock:
+            for name in paths:
+                self.uploaded.pop(name, None)
+
+    def _entry(self, op, name):
+        from storage3.utils import StorageException
+
+        entry = self.index[op].get(name)
+        if entry is None or 'error' in entry:
+            raise StorageException({'message': entry['error'] if entry else f'No recorded {op} for {name}'})
+        return entry
+
+    def _count(self, op):
+        time.sleep(self.latency if self.latency != 'recorded' else 0.0)
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+
+
+def fixture_key(method, url, body=None):
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    return hashlib.sha256(method.encode('ascii') + b' ' + url.encode('utf8') + b'\n' + (body or b'')).hexdigest()
+
+
+def write_file(path, content):
+    tmp_path = f'{path}.{threading.get_ident()}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def parse_latency(value):
+    """`--latency` takes milliseconds or 'recorded'"""
+    return value if value == 'recorded' else float(value) / 1000
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import time
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+MIN_SLEEP = 60
+
+
+def due_sections(state, intervals, now=None):
+    """The sections of `intervals` ({section: seconds their data stays fresh}) that never ran or went stale"""
+    now = time.time() if now is None else now
+    runs = state.get('sources', {})
+    return {section for section, interval in intervals.items()
+            if now - runs.get(section, {}).get('last_run', 0) >= interval}
+
+
+def record_runs(state, sections, now=None):
+    """Remembers when `sections` last ran successfully"""
+    now = time.time() if now is None else now
+    runs = state.setdefault('sources', {})
+    for section in sections:
+        runs.setdefault(section, {})['last_run'] = now
+
+
+def seconds_until_due(state, intervals, now=None):
+    now = time.time() if now is None else now
+    runs = state.get('sources', {})
+    waits = [runs.get(section, {}).get('last_run', 0) + interval - now for section, interval in intervals.items()]
+    return max(min(waits, default=0), MIN_SLEEP)
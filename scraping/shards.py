@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import json
+import os
+from urllib.parse import quote
+
+import brotli
+
+from scraping.records import encode_record
+
+SHARD_DIR = 'static/data'
+PAGE_SIZE = 12
+# section -> [(page name, field to sort on, newest first, which items it lists)], a None field keeps the order the
+# scraper ranked them in. The views are the ones of scraping.views: favorites carry their release date as last_watch and
+# books being read are listed on their own, so both are kept out of the recent pages.
+SHARD_VIEWS = {
+    'movies': [
+        ('recent', 'last_watch', lambda movie: not movie['is_favorite']),
+        ('favorites', None, lambda movie: movie['is_favorite']),
+        ('cinema', 'last_watch', lambda movie: movie['cinema']),
+    ],
+    'shows': [
+        ('recent', 'last_watch', lambda show: not show['is_favorite']),
+        ('favorites', None, lambda show: show['is_favorite']),
+    ],
+    'books': [
+        ('recent', 'added_at', lambda book: not book['is_favorite'] and not book['reading']),
+        ('favorites', None, lambda book: book['is_favorite']),
+        ('reading', None, lambda book: book['reading']),
+    ],
+    'spotify': [('top', None, None)],
+    'github': [('top', None, None)],
+    'videogames': [('top', None, None)],
+}
+
+
+def write_shards(data, shard_dir=SHARD_DIR, page_size=PAGE_SIZE):
+    """Writes the views of every section as sorted pages of `page_size` items under `shard_dir`, plus an index.json.
+
+    Shows are listed without their episodes, which go to `shows/<guid>/episodes.json`.
+    Every file gets precompressed .gz and .br siblings.
+    Files whose content did not change are left alone, and the index is written
+    last so that it never lists a page that is not there yet.
+    """
+    previous = load_index(shard_dir)
+    known = {entry['path']: entry['sha256'] for entry in index_entries(previous)}
+    index = {'page_size': page_size, 'sections': {}, 'episodes': {}}
+    written = 0
+
+    for section, all_items in data.items():
+        index['sections'][section] = {}
+        for view, field, keep in SHARD_VIEWS.get(section, [('all', None, None)]):
+            items = all_items if keep is None else [item for item in all_items if keep(item)]
+            if field is not None:
+                items = sorted(items, key=lambda item: item[field], reverse=True)
+            pages = []
+            for i, start in enumerate(range(0, len(items), page_size)):
+                page = [shard_item(section, item) for item in items[start:start + page_size]]
+                entry, changed = write_shard(shard_dir, f'{section}/{view}-{i}.json', page, known)
+                pages.append(entry)
+                written += changed
+            index['sections'][section][view] = {'count': len(items), 'sort': field, 'pages': pages}
+
+    for show in data.get('shows', []):
+        if show['episodes']:
+            path = f'shows/{quote(str(show["guid"]), safe="")}/episodes.json'
+            index['episodes'][show['guid']], changed = write_shard(shard_dir, path, show['episodes'], known)
+            written += changed
+
+    write_shard(shard_dir, 'index.json', index, {})
+    kept = {entry['path'] for entry in index_entries(index)}
+    removed = [path for path in known if path not in kept]
+    for path in removed:
+        for suffix in ('', '.gz', '.br'):
+            try:
+                os.remove(os.path.join(shard_dir, path + suffix))
+            except OSError:
+                pass
+    print(f'Wrote data shards to {shard_dir}: {written} changed, {len(kept) - written} unchanged, '
+          f'{len(removed)} removed')
+
+
+def shard_item(section, item):
+    if section != 'shows':
+        return item
+    item = item.to_dict()
+    item['episodes'] = len(item['episodes'])
+    return item
+
+
+def write_shard(shard_dir, path, value, known):
+    """Writes `value` to `path` and its compressed siblings unless `known` says it is unchanged"""
+    content = json.dumps(value, default=encode_record, separators=(',', ':')).encode('utf8')
+    digest = hashlib.sha256(content).hexdigest()
+    entry = {'path': path, 'count': len(value), 'bytes': len(content), 'sha256': digest}
+    full_path = os.path.join(shard_dir, path)
+    if known.get(path) == digest and os.path.exists(full_path):
+        return entry, False
+
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    for suffix, encoded in compressed(content):
+        tmp_path = f'{full_path}{suffix}.part'
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_path, full_path + suffix)
+    return entry, True
+
+
+def compressed(content):
+    yield '', content
+    yield '.gz', gzip.compress(content, compresslevel=9, mtime=0)
+    yield '.br', brotli.compress(content, quality=11)
+
+
+def load_index(shard_dir=SHARD_DIR):
+    try:
+        with open(os.path.join(shard_dir, 'index.json'), encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def index_entries(index):
+    for views in index.get('sections', {}).values():
+        if 'pages' in views:  # index written before sections were split into views
+            yield from views['pages']
+            continue
+        for view in views.values():
+            yield from view['pages']
+    yield from index.get('episodes', {}).values()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import functools
+import os
+
+from scraping.cache import get_cache
+from scraping.igdb import IGDB_GAMES_URL, fetch_games, game_queries, igdb_headers, order_games
+from scraping.items import (CONTENT_LIMIT, GITHUB_REPOS_URL, IGDB_GAME_IDS, OKU_COLLECTION_URL, OKU_FAVORITES,
+                            OKU_READ, OKU_READING, SPOTIFY_TOKEN_URL, TWITCH_TOKEN_URL, artist_image_url,
+                            artist_item, book_item, game_cover_url, game_item, github_projects, repo_item, slugify,
+                            spotify_token_headers, spotify_top_artists_url)
+from scraping.net import get_client
+from scraping.schedule import DAY, HOUR
+from scraping.trace import span
+
+COSTS = {'heavy': 3, 'medium': 2, 'light': 1}  # expected run time, heavy sources are started first
+DEADLINES = {'heavy': 15 * 60, 'medium': 5 * 60, 'light': 2 * 60}  # seconds all requests of a source may take
+
+SOURCES = {}
+
+
+class ImageSpec:
+    def __init__(self, media_type, slug, ext, url, square=False):
+        self.media_type = media_type
+        self.slug = slug
+        self.ext = ext
+        self.url = url
+        self.square = square
+
+
+class Source:
+    """One section of the scraper output and the steps that produce it.
+
+    A source either fetches the JSON of `urls`, or calls its own `fetch`
+    (threaded runtime) and `afetch(client)` (asyncio runtime). `parse` turns
+    what was fetched into entries, `image` returns the ImageSpec of an entry's
+    cover, if any, and `item` builds the record of an entry once its image
+    filenames are known. Sources without steps are `custom`: each runtime
+    brings its own scraper for them.
+
+    `hosts` are capped at `concurrency` requests in flight, `cost` orders the
+    sources so that the slowest start first and `refresh` is how long their
+    data stays fresh for --only-due. Every request of the source, covers
+    included, has to fit in `deadline` seconds (by default from its cost).
+    """
+
+    def __init__(self, name, cost='light', refresh=DAY, hosts=(), concurrency=None, limit=CONTENT_LIMIT,
+                 urls=(), cache_key=None, fetch=None, afetch=None, parse=None, image=None, item=None, deadline=None):
+        self.name = name
+        self.cost = cost
+        self.refresh = refresh
+        self.deadline = DEADLINES[cost] if deadline is None else deadline
+        self.hosts = hosts
+        self.concurrency = concurrency
+        self.limit = limit
+        self.urls = urls
+        self.cache_key = cache_key or name
+        self._fetch = fetch
+        self._afetch = afetch
+        self.parse = parse
+        self.image = image or (lambda entry: None)
+        self.item = item
+
+    @property
+    def custom(self):
+        return self.item is None
+
+    def apply_limits(self, client):
+        if self.concurrency is not None:
+            for host in self.hosts:
+                client.set_host_limit(host, self.concurrency)
+
+    def fetch(self):
+        if self._fetch is not None:
+            return self._fetch(self.limit)
+        return [get_cache().fetch_json(url, self.cache_key) for url in self.urls]
+
+    async def afetch(self, client):
+        import asyncio  # the asyncio runtime has it loaded already, the threaded one never needs it
+
+        if self._afetch is not None:
+            return await self._afetch(client, self.limit)
+        return await asyncio.gather(*(client.fetch_json(url, self.cache_key) for url in self.urls))
+
+    def scrape(self, data, images, pending):
+        """Threaded runtime: submits every cover to the `images` pipeline and moves on"""
+        with span('fetch', 'source'):
+            raw = self.fetch()
+        for entry in self.parse(raw, self.limit):
+            item = self.item(entry, pending)
+            spec = self.image(entry)
+            if spec is not None:
+                images.submit(item, spec.media_type, spec.slug, spec.ext, spec.url, square=spec.square)
+            data[self.name].append(item)
+
+    async def ascrape(self, data, client, save_images):
+        """asyncio runtime: `save_images(media_type, slug, ext, url, square)` returns the image filenames"""
+        import asyncio
+
+        with span('fetch', 'source'):
+            raw = await self.afetch(client)
+        entries = self.parse(raw, self.limit)
+
+        async def build(entry):
+            spec = self.image(entry)
+            if spec is None:
+                return self.item(entry, None)
+            return self.item(entry, await save_images(spec.media_type, spec.slug, spec.ext, spec.url, spec.square))
+
+        data[self.name] += await asyncio.gather(*(build(entry) for entry in entries))
+
+
+def register(source):
+    SOURCES[source.name] = source
+    return source
+
+
+def select_sources(names=None):
+    """The registered sources called `names`, all of them if `names` is empty"""
+    if not names:
+        return list(SOURCES.values())
+    unknown = [name for name in names if name not in SOURCES]
+    if unknown:
+        raise ValueError(f'Unknown sources: {", ".join(unknown)} (available: {", ".join(SOURCES)})')
+    return [SOURCES[name] for name in names]
+
+
+def by_cost(sources):
+    """Most expensive first, registration order among equals"""
+    return sorted(sources, key=lambda source: COSTS[source.cost], reverse=True)
+
+
+def refresh_intervals():
+    return {name: source.refresh for name, source in SOURCES.items()}
+
+
+def parse_books(raw, limit):
+    favorites, read, reading = raw
+    books = [(book, True, False) for book in favorites['books']]
+    books += [(book, False, False) for book in read['books'][:limit]]
+    books += [(book, False, True) for book in reading['books'][:limit]]
+    return books
+
+
+def fetch_spotify(limit):
+    res = get_client().post(url=SPOTIFY_TOKEN_URL, data=spotify_token_body(), headers=spotify_headers()).json()
+    if 'access_token' not in res:
+        print(f'Warning: Error refreshing Spotify token: {res}')
+        return {'items': []}
+    return get_client().get(url=spotify_top_artists_url(limit),
+                            headers={'Authorization': 'Bearer {}'.format(res['access_token'])}).json()
+
+
+async def afetch_spotify(client, limit):
+    res = (await client.post(SPOTIFY_TOKEN_URL, data=spotify_token_body(), headers=spotify_headers())).json()
+    if 'access_token' not in res:
+        print(f'Warning: Error refreshing Spotify token: {res}')
+        return {'items': []}
+    response = await client.get(spotify_top_artists_url(limit),
+                                headers={'Authorization': 'Bearer {}'.format(res['access_token'])})
+    return response.json()
+
+
+def spotify_token_body():
+    return {'grant_type': 'refresh_token', 'refresh_token': os.environ.get("SPOTIFY_REFRESH_TOKEN")}
+
+
+def spotify_headers():
+    return spotify_token_headers(os.environ.get("SPOTIFY_CLIENT_ID"), os.environ.get("SPOTIFY_CLIENT_SECRET"))
+
+
+def fetch_videogames(limit):
+    client_id = os.environ.get("IGDB_CLIENT_ID")
+
+    @functools.cache
+    def headers():  # the token is only needed if some games are not cached
+        response = get_client().post(TWITCH_TOKEN_URL, params=twitch_token_params())
+        return igdb_headers(client_id, response.json()['access_token'])
+
+    games, missing = fetch_games(IGDB_GAME_IDS, headers)
+    if missing:
+        print(f'Warning: IGDB games not found: {", ".join(missing)}')
+    return games
+
+
+async def afetch_videogames(client, limit):
+    import asyncio
+    import httpx
+
+    client_id = os.environ.get("IGDB_CLIENT_ID")
+    token = None
+
+    async def headers():  # the token is only needed if some games are not cached
+        nonlocal token
+        if token is None:
+            token = asyncio.ensure_future(client.post(TWITCH_TOKEN_URL, params=twitch_token_params()))
+        return igdb_headers(client_id, (await token).json()['access_token'])
+
+    async def fetch_page(page, query):
+        try:
+            return await client.fetch_json(IGDB_GAMES_URL, 'igdb', method='POST', headers=headers, data=query,
+                                           retry_status=True)
+        except (httpx.HTTPError, ValueError) as exc:
+            print(f'Warning: IGDB query for {len(page)} games failed: {exc}')
+            return []
+
+    pages = await asyncio.gather(*(fetch_page(page, query) for page, query in game_queries(IGDB_GAME_IDS)))
+    games, missing = order_games(IGDB_GAME_IDS, {str(game['id']): game for page in pages for game in page})
+    if missing:
+        print(f'Warning: IGDB games not found: {", ".join(missing)}')
+    return games
+
+
+def twitch_token_params():
+    return {'client_id': os.environ.get("IGDB_CLIENT_ID"), 'client_secret': os.environ.get("IGDB_CLIENT_SECRET"),
+            'grant_type': 'client_credentials'}
+
+
+# Plex history and metadata are shared between movies and shows, so both runtimes bring their own scrapers
+register(Source('movies', cost='heavy', refresh=6 * HOUR))
+register(Source('shows', cost='heavy', refresh=6 * HOUR))
+register(Source(
+    'books', cost='medium', hosts=('oku.club',), concurrency=3, cache_key='oku',
+    urls=[OKU_COLLECTION_URL + collection for collection in (OKU_FAVORITES, OKU_READ, OKU_READING)],
+    parse=parse_books,
+    image=lambda entry: ImageSpec('book', entry[0]['slug'], 'jpg', entry[0]['thumbnail']),
+    item=lambda entry, images: book_item(entry[0], images, is_favorite=entry[1], reading=entry[2]),
+))
+register(Source(
+    'spotify', cost='medium', hosts=('api.spotify.com',), concurrency=2,
+    fetch=fetch_spotify, afetch=afetch_spotify,
+    parse=lambda raw, limit: raw['items'],
+    image=lambda item: ImageSpec('artist', slugify(item['name']), 'jpeg', artist_image_url(item), square=True),
+    item=artist_item,
+))
+register(Source(
+    'github', hosts=('api.github.com',), concurrency=1,
+    urls=[GITHUB_REPOS_URL],
+    parse=lambda raw, limit: github_projects(raw[0], limit),
+    item=lambda project, images: repo_item(project),
+))
+register(Source(
+    'videogames', cost='medium', refresh=30 * DAY,  # hardcoded IGDB ids, only changes when IGDB_GAME_IDS does
+    hosts=('api.igdb.com',), concurrency=4,  # IGDB allows 4 open requests
+    fetch=fetch_videogames, afetch=afetch_videogames,
+    parse=lambda games, limit: games,
+    image=lambda game: ImageSpec('game', slugify(game['name']), 'jpg', game_cover_url(game)),
+    item=game_item,
+))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+STATE_PATH = '.cache/scraper/state.json'
+
+
+def load_state(path=STATE_PATH):
+    try:
+        with open(path, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, path=STATE_PATH):
+    tmp_path = f'{path}.part'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        print(f'Warning: Failed to save scraper state: {exc}')
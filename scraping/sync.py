@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import UTC, datetime
+
+from scraping.net import CHUNK_SIZE, retry_delay
+from scraping.trace import span
+
+STORAGE_TIMEOUT = 120
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 1
+UPLOAD_CONCURRENCY = 3
+UPLOAD_SEMAPHORE = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+SYNC_CONCURRENCY = 8
+LIST_PAGE_SIZE = 1000
+BUCKET_MANIFEST = 'manifest.json'
+SIGNED_URL_TTL = 10 * 60  # seconds the URLs that bucket files are downloaded from stay valid
+
+
+class BucketSync:
+    """Tracks the bucket contents through a manifest object stored in the bucket itself.
+
+    Loading the manifest is a single download, no matter how many files the
+    bucket holds. Scrapers queue the uploads and downloads they need and `run`
+    transfers them in parallel before saving the updated manifest.
+
+    `connect` returns the bucket. It is only called, and the manifest only
+    loaded, once a lookup or transfer needs them, so runs that touch no
+    images never create a storage client.
+    """
+
+    def __init__(self, connect, manifest_name=BUCKET_MANIFEST, concurrency=SYNC_CONCURRENCY):
+        self.manifest_name = manifest_name
+        self.concurrency = concurrency
+        self.files = {}  # name -> {'size', 'sha256'}
+        self.available = True
+        self._connect = connect
+        self._bucket = None
+        self._connect_lock = threading.Lock()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._uploads = {}
+        self._downloads = {}
+        self._removals = set()
+        self._transferring = set()  # taken from the queues but not done yet
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def __contains__(self, filename):
+        self.ensure_loaded()
+        with self._lock:
+            return filename in self.files or filename in self._uploads
+
+    @property
+    def bucket(self):
+        with self._connect_lock:
+            if self._bucket is None:
+                with span('connect', 'bucket'):
+                    self._bucket = self._connect()
+            return self._bucket
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def size(self, filename):
+        """Size of the file in the bucket as far as the manifest knows, or None"""
+        self.ensure_loaded()
+        with self._lock:
+            return (self.files.get(filename) or {}).get('size')
+
+    def ensure_loaded(self):
+        """Loads the manifest on first use. A bucket that cannot be reached counts as empty and unavailable:
+        images are then made locally and nothing is transferred or saved.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            try:
+                self.load()
+            except Exception as exc:
+                print(f'Warning: Bucket unavailable, continuing without it: {exc}')
+                self.available = False
+                self._loaded = True
+
+    def load(self):
+        from storage3.utils import StorageException
+
+        try:
+            manifest = json.loads(self.bucket.download(self.manifest_name))
+        except (StorageException, ValueError) as exc:
+            print(f'No usable bucket manifest ({exc}), rebuilding it from a listing...')
+            self.reconcile(known={})
+            return
+        with self._lock:
+            self.files = manifest['files']
+        self._loaded = True
+        print(f'Loaded bucket manifest with {len(self.files)} files')
+
+    def reconcile(self, known=None):
+        """Rebuilds the manifest from a full listing of the bucket, keeping known hashes of unchanged files.
+
+        `known` are the files of the current manifest, which is read from the
+        bucket (if it is readable) when not given.
+        """
+        if known is None:
+            known = (self.read_json(self.manifest_name) or {}).get('files', {})
+        listed = {}
+        offset = 0
+        while True:
+            page = self.bucket.list(options={'limit': LIST_PAGE_SIZE, 'offset': offset})
+            for f in page:
+                if not f['name'].endswith('.json') and f.get('id') is not None:  # the manifests are not tracked
+                    listed[f['name']] = {'size': (f.get('metadata') or {}).get('size')}
+            if len(page) < LIST_PAGE_SIZE:
+                break
+            offset += LIST_PAGE_SIZE
+
+        with self._lock:
+            known = {**known, **self.files}
+            for name, entry in listed.items():
+                file = known.get(name)
+                if file is not None and file.get('size') == entry['size']:
+                    entry['sha256'] = file.get('sha256')
+            added = listed.keys() - known.keys()
+            removed = known.keys() - listed.keys()
+            self.files = listed
+            self._dirty = True
+        self._loaded = True
+        print(f'Reconciled bucket manifest: {len(listed)} files, {len(added)} added, {len(removed)} removed')
+
+    def queue_upload(self, filename, path):
+        self.ensure_loaded()
+        if not self.available:
+            return
+        with self._lock:
+            if filename not in self.files and filename not in self._transferring:
+                self._uploads[filename] = path
+
+    def queue_download(self, filename, path):
+        if not self.available:
+            return
+        with self._lock:
+            if filename not in self._transferring:
+                self._downloads[filename] = path
+
+    def queue_removal(self, filenames):
+        """Files to remove from the bucket on the next `run`"""
+        self.ensure_loaded()
+        if not self.available:
+            return
+        with self._lock:
+            for filename in filenames:
+                self._uploads.pop(filename, None)
+                if filename in self.files:
+                    self._removals.add(filename)
+
+    def take_queued(self):
+        """Returns and clears the queued ({name: path} downloads, {name: path} uploads)"""
+        with self._lock:
+            uploads, self._uploads = self._uploads, {}
+            downloads, self._downloads = self._downloads, {}
+            self._transferring.update(uploads, downloads)
+        return downloads, uploads
+
+    def run(self):
+        """Transfers every queued file with bounded concurrency, removes the queued removals, then saves the manifest"""
+        downloads, uploads = self.take_queued()
+        if uploads or downloads:
+            print(f'Syncing bucket: {len(downloads)} downloads, {len(uploads)} uploads...')
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {executor.submit(self.download_to, name, path): name for name, path in downloads.items()}
+                futures.update({executor.submit(self.upload_from, name, path): name for name, path in uploads.items()})
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        print(f'Warning: Sync failed for {futures[future]}: {exc}')
+            print(f'Bucket sync took {time.perf_counter() - start:.2f}s')
+        with self._lock:
+            removals, self._removals = sorted(self._removals), set()
+        if removals:
+            try:
+                self.remove(removals)
+            except Exception as exc:
+                print(f'Warning: Failed to remove superseded files from the bucket: {exc}')
+        self.save()
+
+    def remove(self, filenames):
+        for start in range(0, len(filenames), LIST_PAGE_SIZE):
+            self.bucket.remove(filenames[start:start + LIST_PAGE_SIZE])
+            with self._lock:
+                for filename in filenames[start:start + LIST_PAGE_SIZE]:
+                    self.files.pop(filename, None)
+                self._dirty = True
+        print(f'Removed {len(filenames)} superseded files from the bucket')
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            manifest = {'files': self.files, 'updated_at': datetime.now(UTC).isoformat()}
+            self._dirty = False
+        self.write_json(self.manifest_name, manifest)
+
+    def read_json(self, name):
+        """An untracked JSON object next to the manifest, None if it is missing or unreadable"""
+        from storage3.utils import StorageException
+
+        try:
+            return json.loads(self.bucket.download(name))
+        except (StorageException, ValueError):
+            return None
+
+    def write_json(self, name, value):
+        content = json.dumps(value, sort_keys=True).encode('utf8')
+        self.bucket.upload(name, content, file_options={'content-type': 'application/json', 'upsert': 'true'})
+
+    def _remember(self, filename, size, sha256=None):
+        with self._lock:
+            self.files[filename] = {'size': size, 'sha256': sha256}
+            self._dirty = True
+
+    def download_to(self, filename, path):
+        """Streams the file to `path` through a signed URL, hashing it on the way, and checks it against the manifest.
+
+        Buckets that cannot sign URLs (the recorded ones of benchmark.py) only
+        hand out whole bodies, which are then held in memory.
+        """
+        from scraping.media import download  # media imports this module
+
+        fetched = None
+        try:
+            with span('download_to', 'bucket') as s:
+                if hasattr(self.bucket, 'create_signed_url'):
+                    fetched = download(signed_url(self.bucket, filename))
+                    source, digest = fetched.path, fetched.digest
+                    s.set(bytes=fetched.size)
+                else:
+                    content = self.bucket.download(filename)
+                    source, digest = None, hashlib.sha256(content).hexdigest()
+                    s.set(bytes=len(content))
+            with self._lock:
+                expected = self.files.get(filename, {})
+            if expected.get('sha256') and digest != expected['sha256']:
+                raise RuntimeError(f'Checksum mismatch for {filename}')
+            tmp_path = f'{path}.part'
+            if source is None:
+                with open(tmp_path, 'wb') as f:
+                    f.write(content)
+            else:
+                shutil.move(source, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if fetched is not None:
+                fetched.discard()
+            self._done(filename)
+
+    def upload_from(self, filename, path):
+        try:
+            with HashingReader(path) as f:
+                upload_file(self.bucket, filename, f, get_content_type(path))
+                self._remember(filename, f.size, f.hexdigest())
+        finally:
+            self._done(filename)
+
+    def _done(self, filename):
+        with self._lock:
+            self._transferring.discard(filename)
+
+
+class HashingReader(io.BufferedReader):
+    """File handed to the storage client, which streams it in chunks, hashed as the upload reads it.
+
+    The storage client rewinds it before every attempt and closes it once
+    the upload succeeds, so the file is read once per attempt and never
+    held in memory as a whole.
+    """
+
+    def __init__(self, path):
+        super().__init__(io.FileIO(path, 'rb'))
+        self.path = path
+        self.size = os.fstat(self.fileno()).st_size
+        self._sha256 = hashlib.sha256()
+        self._hashed = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self._sha256.update(chunk)
+        self._hashed += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = super().seek(offset, whence)
+        if position == 0:
+            self._sha256, self._hashed = hashlib.sha256(), 0
+        return position
+
+    def hexdigest(self):
+        """sha256 of the file, reading the rest of it if the upload stopped early (e.g. it already existed)"""
+        if not self.closed:
+            while self.read(CHUNK_SIZE):
+                pass
+        if self._hashed != self.size:  # read in some other way than sequential reads from the start
+            return file_hash(self.path)
+        return self._sha256.hexdigest()
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def upload_file(bucket, filename, f, content_type, retries=UPLOAD_RETRIES):
+    """Uploads the open file `f`, which the storage client streams instead of loading it"""
+    from storage3.utils import StorageException
+
+    file_options = {'content-type': content_type, 'upsert': 'false'}
+
+    with span('upload_file', 'bucket', bytes=os.fstat(f.fileno()).st_size) as s:
+        for attempt in range(1, retries + 1):
+            s.set(retries=attempt - 1)
+            try:
+                with UPLOAD_SEMAPHORE:
+                    bucket.upload(filename, f, file_options=file_options)
+                return
+            except StorageException as exc:
+                if is_duplicate_storage_error(exc):
+                    s.outcome = 'exists'
+                    return
+                if bucket_file_exists(bucket, filename):
+                    s.outcome = 'exists'
+                    return
+                if attempt == retries:
+                    raise RuntimeError(f'Failed to upload {filename} after {retries} attempts') from exc
+                print(f'Upload failed for {filename} (attempt {attempt}/{retries}): {exc}. Retrying...')
+                time.sleep(retry_delay(UPLOAD_BACKOFF, attempt))
+            except Exception as exc:
+                if bucket_file_exists(bucket, filename):
+                    s.outcome = 'exists'
+                    return
+                if attempt == retries:
+                    raise RuntimeError(f'Failed to upload {filename} after {retries} attempts') from exc
+                print(f'Upload failed for {filename} (attempt {attempt}/{retries}): {exc}. Retrying...')
+                time.sleep(retry_delay(UPLOAD_BACKOFF, attempt))
+
+
+def get_supabase_bucket():
+    from supabase import create_client, Client, ClientOptions  # by far the slowest import, only load it when needed
+
+    url: str = os.environ.get("SUPABASE_URL")
+    key: str = os.environ.get("SUPABASE_KEY")
+    bucket_name: str = os.environ.get("SUPABASE_BUCKET_NAME")
+    supabase: Client = create_client(url, key, options=ClientOptions(storage_client_timeout=STORAGE_TIMEOUT))
+    bucket = supabase.storage.from_(bucket_name)
+    return bucket
+
+
+def signed_url(bucket, filename):
+    """A short-lived URL of the file that the shared HTTP client can stream"""
+    signed = bucket.create_signed_url(filename, SIGNED_URL_TTL)
+    return signed.get('signedURL') or signed['signedUrl']
+
+
+def get_content_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    return {
+        '.jpg': 'image/jpeg',
+        '.jpeg': 'image/jpeg',
+        '.png': 'image/png',
+        '.webp': 'image/webp',
+        '.avif': 'image/avif',
+    }.get(ext, 'application/octet-stream')
+
+
+def is_duplicate_storage_error(exc):
+    message = str(exc)
+    return 'Duplicate' in message or '409' in message
+
+
+def bucket_file_exists(bucket, filename):
+    try:
+        return bucket.exists(filename)
+    except Exception:
+        return False
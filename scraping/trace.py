@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import UTC, datetime
+
+REPORT_PATH = '.cache/scraper/report.json'  # outside data/, which Hugo would load as site.Data
+REPORT_CATEGORIES = ('phase', 'section', 'source')  # kept span by span in the report, the rest is aggregated
+SLOWEST_HOSTS = 3
+
+_current = contextvars.ContextVar('current_span', default=None)
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, span_id, name, category, parent, lane, start, attrs):
+        self.id = span_id
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.lane = lane
+        self.start = start
+        self.end = None
+        self.outcome = 'ok'
+        self.attrs = attrs
+
+    @property
+    def duration(self):
+        return (self.end or self.start) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {'name': self.name, 'category': self.category, 'start': round(self.start, 4),
+                'duration': round(self.duration, 4), 'outcome': self.outcome, **self.attrs}
+
+
+class Tracer:
+    """Collects timed spans from every thread and task of a run.
+
+    Spans nest through a context variable, so a span opened inside another
+    one, in the same thread or in an asyncio task started from it, records it
+    as its parent. Times are seconds since the tracer was created.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.started_at = datetime.now(UTC)
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category, **attrs):
+        parent = _current.get()
+        span = Span(next(self._ids), name, category, parent.id if parent is not None else None, current_lane(),
+                    time.perf_counter() - self.origin, attrs)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.outcome = f'error: {type(exc).__name__}'
+            raise
+        finally:
+            span.end = time.perf_counter() - self.origin
+            _current.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def finished(self, category=None):
+        with self._lock:
+            return [s for s in self.spans if category is None or s.category == category]
+
+    def durations(self, category):
+        totals = {}
+        for s in self.finished(category):
+            totals[s.name] = totals.get(s.name, 0.0) + s.duration
+        return totals
+
+    def aggregate(self):
+        """{category: {name: count, time, errors, bytes, retries}} of every span"""
+        summary = {}
+        for s in self.finished():
+            entry = summary.setdefault(s.category, {}).setdefault(
+                s.name, {'count': 0, 'time': 0.0, 'errors': 0, 'bytes': 0, 'retries': 0})
+            entry['count'] += 1
+            entry['time'] = round(entry['time'] + s.duration, 4)
+            entry['errors'] += s.outcome != 'ok'
+            entry['bytes'] += s.attrs.get('bytes') or 0
+            entry['retries'] += s.attrs.get('retries') or 0
+        return summary
+
+    def critical_path(self):
+        """For every phase, the chain of sections that kept it running until its end"""
+        sections = self.finished('section')
+        path = []
+        for phase in sorted(self.finished('phase'), key=lambda s: s.start):
+            inside = [s for s in sections if s.start >= phase.start and s.end <= phase.end]
+            chain, until = [], phase.end
+            while True:
+                before = [s for s in inside if s.end <= until and s not in chain]
+                if not before:
+                    break
+                chain.append(max(before, key=lambda s: s.end))
+                until = chain[-1].start
+            path.append({'phase': phase.name, 'duration': round(phase.duration, 4), 'outcome': phase.outcome,
+                         'sections': [self._breakdown(s) for s in reversed(chain)]})
+        return path
+
+    def _breakdown(self, section):
+        """The section with the source functions it spent its time in"""
+        spans = self.finished('source')
+        children = [s for s in spans if s.parent == section.id]
+        while len(children) == 1:  # skip wrappers such as scrape_all_movies
+            nested = [s for s in spans if s.parent == children[0].id]
+            if not nested:
+                break
+            children = nested
+        return {'name': section.name, 'duration': round(section.duration, 4), 'outcome': section.outcome,
+                'sources': [{'name': s.name, 'duration': round(s.duration, 4)}
+                            for s in sorted(children, key=lambda s: s.start)]}
+
+    def report(self):
+        spans = sorted(self.finished(), key=lambda s: s.start)
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall': round(max((s.end for s in spans), default=0.0), 4),
+            'critical_path': self.critical_path(),
+            'spans': [s.to_dict() for s in spans if s.category in REPORT_CATEGORIES],
+            'totals': self.aggregate(),
+        }
+
+    def write_report(self, path=REPORT_PATH):
+        tmp_path = f'{path}.part'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(self.report(), f, indent=1)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f'Warning: Failed to write run report: {exc}')
+
+    def write_chrome_trace(self, path):
+        """Trace Event Format, opens in chrome://tracing and ui.perfetto.dev"""
+        spans = self.finished()
+        lanes = {lane: i for i, lane in enumerate(dict.fromkeys(s.lane for s in sorted(spans, key=lambda s: s.start)))}
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': lane}}
+                  for lane, tid in lanes.items()]
+        events += [{'name': s.name, 'cat': s.category, 'ph': 'X', 'pid': 1, 'tid': lanes[s.lane],
+                    'ts': round(s.start * 1e6), 'dur': round(s.duration * 1e6),
+                    'args': {'outcome': s.outcome, **s.attrs}} for s in spans]
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print(f'Wrote Chrome trace with {len(spans)} spans to {path}')
+
+    def print_summary(self):
+        path = self.critical_path()
+        if not path:
+            return
+        print(f'Critical path: {sum(step["duration"] for step in path):.2f}s')
+        for step in path:
+            sections = ' -> '.join(describe_section(s) for s in step['sections'])
+            print(f'  {step["phase"]:<8} {step["duration"]:7.2f}s  {sections}'.rstrip())
+
+        hosts = sorted(self.aggregate().get('http', {}).items(), key=lambda item: item[1]['time'], reverse=True)
+        if hosts:
+            print('Slowest hosts: ' + ', '.join(f'{host} {s["time"]:.2f}s over {s["count"]} requests'
+                                                for host, s in hosts[:SLOWEST_HOSTS]))
+
+
+def describe_section(section):
+    text = f'{section["name"]} {section["duration"]:.2f}s'
+    if section['sources']:
+        text += ' (' + ', '.join(f'{s["name"]} {s["duration"]:.2f}s' for s in section['sources']) + ')'
+    return text
+
+
+def current_lane():
+    """Thread name, or task name inside asyncio, so that spans on one lane never overlap"""
+    asyncio = sys.modules.get('asyncio')  # not imported yet means that no task can be running
+    try:
+        task = asyncio.current_task() if asyncio is not None else None
+    except RuntimeError:
+        task = None
+    return task.get_name() if task is not None else threading.current_thread().name
+
+
+def traced(category):
+    """Wraps every call of the decorated function, or coroutine function, in a span named after it"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with get_tracer().span(func.__name__, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_tracer().span(func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def span(name, category, **attrs):
+    return get_tracer().span(name, category, **attrs)
+
+
+def configure_tracer():
+    global _tracer
+    with _tracer_lock:
+        _tracer = Tracer()
+        return _tracer
+
+
+def get_tracer():
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+        return _tracer
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from datetime import datetime, timezone
+
+VIEWS_PATH = 'data/views.json'  # site.Data.views for Hugo
+
+
+def build_views(data):
+    """Precomputes the lists and counts the shortcodes show, so that Hugo does not filter and sort on every page.
+
+    Lists are indices into the matching `site.Data.scraper` section, already
+    in the order they are rendered in. Counts are keyed by UTC year and month
+    ("2024", "2024-05") of the watch dates, and episodes by show guid.
+    """
+    movies = data.get('movies', [])
+    shows = data.get('shows', [])
+    books = data.get('books', [])
+    games = data.get('videogames', [])
+    watched = [movie for movie in movies if not movie['is_favorite']]
+    episodes = [episode for show in shows if not show['is_favorite'] for episode in show['episodes']]
+    return {
+        'movies': {
+            'recent': sorted(indices(movies, lambda movie: not movie['is_favorite']),
+                             key=lambda i: movies[i]['last_watch'], reverse=True),
+            'favorites': indices(movies, lambda movie: movie['is_favorite']),
+            'cinema': indices(movies, lambda movie: movie['cinema']),
+        },
+        'shows': {
+            'recent': indices(shows, lambda show: not show['is_favorite']),
+            'favorites': indices(shows, lambda show: show['is_favorite']),
+        },
+        'books': {
+            'recent': indices(books, lambda book: not book['is_favorite'] and not book['reading']),
+            'favorites': indices(books, lambda book: book['is_favorite']),
+            'reading': indices(books, lambda book: book['reading']),
+        },
+        'videogames': {
+            'recent': sorted(range(len(games)), key=lambda i: games[i]['year'], reverse=True),
+        },
+        'stats': {
+            'movies': periods(movie['last_watch'] for movie in watched),
+            'episodes': periods(episode['watched_on'] for episode in episodes),
+            'episodes_per_show': {str(show['guid']): len(show['episodes']) for show in shows if show['episodes']},
+        },
+    }
+
+
+def indices(items, keep):
+    return [i for i, item in enumerate(items) if keep(item)]
+
+
+def periods(timestamps):
+    """{'total', 'per_year', 'per_month'} counts of unix `timestamps`, zero meaning unknown"""
+    dates = [datetime.fromtimestamp(timestamp, timezone.utc) for timestamp in timestamps if timestamp]
+    return {
+        'total': len(dates),
+        'per_year': dict(sorted(Counter(f'{date.year}' for date in dates).items())),
+        'per_month': dict(sorted(Counter(f'{date.year}-{date.month:02d}' for date in dates).items())),
+    }
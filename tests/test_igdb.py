@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import http.server
+import json
+import re
+import threading
+
+import pytest
+
+from scraping.cache import configure_cache
+from scraping.igdb import IGDB_PAGE_LIMIT, fetch_games
+from scraping.items import IGDB_GAME_IDS
+from scraping.net import configure_client
+
+
+class IgdbStub(http.server.BaseHTTPRequestHandler):
+    """Answers Apicalypse `where id = (...)` queries with one game per id and counts them"""
+    queries = []
+
+    def do_POST(self):
+        query = self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')
+        self.queries.append(query)
+        ids = re.search(r'where id = \(([^)]*)\)', query).group(1).split(',')
+        body = json.dumps([{'id': int(i), 'name': f'Game {i}'} for i in ids]).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def igdb_url(tmp_path):
+    IgdbStub.queries = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), IgdbStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    configure_client()
+    configure_cache(path=str(tmp_path), enabled=False)
+    yield f'http://127.0.0.1:{server.server_address[1]}/v4/games'
+    server.shutdown()
+    server.server_close()
+
+
+def test_configured_games_take_one_request(igdb_url):
+    games, missing = fetch_games(IGDB_GAME_IDS, {}, url=igdb_url)
+    assert len(IGDB_GAME_IDS) == 22
+    assert len(IgdbStub.queries) == 1
+    assert [str(game['id']) for game in games] == IGDB_GAME_IDS
+    assert missing == []
+
+
+def test_ids_over_the_page_limit_are_split_into_pages(igdb_url):
+    ids = [str(i) for i in range(1, IGDB_PAGE_LIMIT * 2 + 2)]
+    games, missing = fetch_games(ids, {}, url=igdb_url)
+    assert len(IgdbStub.queries) == 3
+    assert sorted(int(re.search(r'limit (\d+);', query).group(1)) for query in IgdbStub.queries) == \
+        [1, IGDB_PAGE_LIMIT, IGDB_PAGE_LIMIT]
+    assert [game['id'] for game in games] == [int(i) for i in ids]
+    assert missing == []
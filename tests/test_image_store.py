@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import json
+
+from scraping.image_store import BUCKET_MANIFEST, ImageStore
+from scraping.sync import BucketSync
+
+
+class MemoryBucket:
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def download(self, name):
+        from storage3.utils import StorageException
+
+        if name not in self.objects:
+            raise StorageException({'message': 'Object not found', 'statusCode': 404})
+        return self.objects[name]
+
+    def upload(self, name, content, file_options=None):
+        self.objects[name] = content
+
+
+def remote_manifest(checked_at):
+    return json.dumps({
+        'sources': {'https://img/a': {'key': 'movie:abc', 'etag': None, 'last_modified': None,
+                                      'checked_at': checked_at}},
+        'objects': {'movie:abc': {'name': 'movie_a_abc', 'variants': ['movie_a_abc.jpg'], 'slug': 'a',
+                                  'url': 'https://img/a', 'size': 3, 'placeholder': 'data:'}},
+    }).encode('utf8')
+
+
+def test_fresh_build_resolves_urls_from_the_bucket(tmp_path):
+    bucket = MemoryBucket({'manifest.json': b'{"files": {}}', BUCKET_MANIFEST: remote_manifest(checked_at=1)})
+    store = ImageStore(path=str(tmp_path / 'images.json'))
+    store.pull(BucketSync(lambda: bucket))
+    source, entry = store.lookup('https://img/a')
+    assert source['key'] == 'movie:abc'
+    assert entry['name'] == 'movie_a_abc' and entry['placeholder'] == 'data:'
+
+
+def test_push_only_after_changes(tmp_path):
+    bucket = MemoryBucket({'manifest.json': b'{"files": {}}', BUCKET_MANIFEST: remote_manifest(checked_at=1)})
+    sync = BucketSync(lambda: bucket)
+    store = ImageStore(path=str(tmp_path / 'images.json'))
+    store.pull(sync)
+    del bucket.objects[BUCKET_MANIFEST]
+    store.push(sync)
+    assert BUCKET_MANIFEST not in bucket.objects
+
+    store.record('https://img/b', 'movie', 'b', 'def', 'movie_b_def', ['movie_b_def.jpg'], 4)
+    store.push(sync)
+    pushed = json.loads(bucket.objects[BUCKET_MANIFEST])
+    assert set(pushed['sources']) == {'https://img/a', 'https://img/b'}
+
+
+def test_record_returns_the_files_of_a_replaced_image(tmp_path):
+    store = ImageStore(path=str(tmp_path / 'images.json'))
+    store.record('https://img/a', 'movie', 'a', 'abc', 'movie_a_abc', ['movie_a_abc.jpg', 'movie_a_abc.webp'], 3)
+    store.record('https://img/b', 'movie', 'b', 'abc', 'movie_a_abc', ['movie_a_abc.jpg', 'movie_a_abc.webp'], 3)
+    assert store.record('https://img/a', 'movie', 'a', 'def', 'movie_a_def', ['movie_a_def.jpg'], 4) == []
+
+    superseded = store.record('https://img/b', 'movie', 'b', 'def', 'movie_a_def', ['movie_a_def.jpg'], 4)
+    assert superseded == ['movie_a_abc.jpg', 'movie_a_abc.webp']
+    assert store.find('movie', 'abc') is None
+    assert store.filenames() == {'movie_a_def.jpg'}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import http.server
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from scraping.net import HttpClient, configure_client
+
+
+class UnavailableStub(http.server.BaseHTTPRequestHandler):
+    """Answers every request with 503 and counts them"""
+    requests = 0
+
+    def answer(self):
+        UnavailableStub.requests += 1
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowStub(http.server.BaseHTTPRequestHandler):
+    """Answers every GET after `delay` seconds"""
+    delay = 0.2
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def url():
+    UnavailableStub.requests = 0
+    server = serve(UnavailableStub)
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+def test_status_retries_are_for_idempotent_methods(url):
+    client = HttpClient(backoff=0)
+    assert client.get(url).status_code == 503
+    assert UnavailableStub.requests == 3
+    assert client.post(url, data='x').status_code == 503
+    assert UnavailableStub.requests == 4
+    assert client.post(url, data='x', retry_status=True).status_code == 503
+    assert UnavailableStub.requests == 7
+
+
+def test_breaker_counts_each_request_once(url):
+    client = HttpClient(backoff=0)
+    for _ in range(client.breaker.failures - 1):
+        client.get(url)
+    assert client.breaker.open_hosts() == []
+    client.get(url)
+    assert client.breaker.open_hosts() == [url.split('/')[2]]
+
+
+def test_latency_leaves_out_the_wait_for_the_host_slot():
+    server = serve(SlowStub)
+    client = HttpClient(host_limits={}, default_host_limit=1)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(client.get, [f'http://127.0.0.1:{server.server_address[1]}/'] * 3))
+    server.shutdown()
+    server.server_close()
+    latencies = client.stats()['127.0.0.1'].latencies
+    assert len(latencies) == 3
+    assert max(latencies) < 2 * SlowStub.delay  # the last one waited for two others before it was sent
+
+
+def test_requests_queued_for_the_host_are_not_hedged():
+    server = serve(type('FastStub', (SlowStub,), {'delay': 0.01}))
+    client = HttpClient(host_limits={}, default_host_limit=1, hedge=True)
+    with client._lock:
+        client._host_stats('127.0.0.1').latencies.extend([0.1] * 20)
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        list(executor.map(client.get, [f'http://127.0.0.1:{server.server_address[1]}/'] * 20))
+    server.shutdown()
+    server.server_close()
+    assert client.stats()['127.0.0.1'].hedges == 0  # the last ones waited far longer than the p95 for their turn
+
+
+def test_configure_client_closes_the_previous_one():
+    first = configure_client(hedge=True)
+    second = configure_client(hedge=True)
+    with pytest.raises(RuntimeError):  # cannot schedule new futures after shutdown
+        first._hedges.submit(print)
+    second._hedges.submit(print).result()
+    second.close()
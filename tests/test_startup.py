@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from benchmark import measure_startup
+
+
+def test_heavy_modules_are_imported_lazily():
+    # the time budget itself is left to `benchmark.py startup`, wall-clock times vary too much on shared runners
+    _, _, loaded = measure_startup(runs=1)
+    assert loaded == [], f'imported at startup instead of when first used: {loaded}'
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import functools
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+
+from scraping.sync import BucketSync
+
+
+class SigningBucket:
+    """Bucket whose files are served by a local http.server, which only hands them out through signed URLs"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def create_signed_url(self, filename, expires_in):
+        return {'signedURL': f'{self.base_url}/{filename}?token=x'}
+
+    def download(self, filename):
+        raise AssertionError('the whole body should not be downloaded at once')
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    served = tmp_path / 'bucket'
+    served.mkdir()
+    (served / 'cover.jpg').write_bytes(b'cover' * 100_000)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(served))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.chdir(tmp_path)
+    yield SigningBucket(f'http://127.0.0.1:{server.server_address[1]}')
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_streams_through_a_signed_url(bucket, tmp_path):
+    content = b'cover' * 100_000
+    sync = BucketSync(lambda: bucket)
+    sync.files = {'cover.jpg': {'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()}}
+    sync.download_to('cover.jpg', str(tmp_path / 'cover.jpg'))
+    assert (tmp_path / 'cover.jpg').read_bytes() == content
+    assert not list((tmp_path / '.cache' / 'downloads').iterdir())
+
+
+def test_download_checks_the_manifest_hash(bucket, tmp_path):
+    sync = BucketSync(lambda: bucket)
+    sync.files = {'cover.jpg': {'size': 1, 'sha256': 'not the hash'}}
+    with pytest.raises(RuntimeError, match='Checksum mismatch'):
+        sync.download_to('cover.jpg', str(tmp_path / 'cover.jpg'))
+    assert not (tmp_path / 'cover.jpg').exists()
+    assert not list((tmp_path / '.cache' / 'downloads').iterdir())
+
+
+class ListingBucket:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def download(self, name):
+        return self.objects[name]
+
+    def upload(self, name, content, file_options=None):
+        self.objects[name] = content
+
+    def remove(self, paths):
+        for name in paths:
+            del self.objects[name]
+
+    def list(self, options=None):
+        names = sorted(self.objects)[options['offset']:options['offset'] + options['limit']]
+        return [{'name': name, 'id': name, 'metadata': {'size': len(self.objects[name])}} for name in names]
+
+
+def test_reconcile_keeps_the_hashes_of_unchanged_files():
+    manifest = {'files': {'a.jpg': {'size': 3, 'sha256': 'abc'}, 'b.jpg': {'size': 1, 'sha256': 'old'}}}
+    bucket = ListingBucket({'manifest.json': json.dumps(manifest).encode('utf8'), 'a.jpg': b'aaa', 'b.jpg': b'bb'})
+    sync = BucketSync(lambda: bucket)
+    sync.reconcile()
+    sync.save()
+    assert json.loads(bucket.objects['manifest.json'])['files'] == {
+        'a.jpg': {'size': 3, 'sha256': 'abc'},
+        'b.jpg': {'size': 2},  # changed since it was hashed
+    }
+
+
+def test_run_removes_the_queued_files():
+    bucket = ListingBucket({'manifest.json': b'{"files": {"a.jpg": {"size": 3}, "b.jpg": {"size": 3}}}',
+                            'a.jpg': b'aaa', 'b.jpg': b'bbb'})
+    sync = BucketSync(lambda: bucket)
+    sync.queue_removal(['a.jpg', 'unknown.jpg'])
+    sync.run()
+    assert sorted(bucket.objects) == ['b.jpg', 'manifest.json']
+    assert json.loads(bucket.objects['manifest.json'])['files'] == {'b.jpg': {'size': 3}}